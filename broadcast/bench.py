@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+from dslib.message import Message
+from dslib.test_server import TestServer
+
+from test import TEST_SERVER_ADDR, run_peer
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def collect(ts, peers, counts, stats, timeout):
+    # DELIVER и ответ на STATS приходят в одну локальную очередь - разбираем их по типу
+    for peer in peers:
+        msg = ts.wait_local_message(peer, timeout)
+        while msg is not None:
+            if msg.type == 'DELIVER':
+                counts[peer] += 1
+            elif msg.type == 'STATS':
+                stats[peer] = msg.body
+                break
+            msg = ts.wait_local_message(peer, timeout)
+
+
+def run_bench(args, n, mode):
+    ts = TestServer(TEST_SERVER_ADDR)
+    ts.start()
+    names = ['peer%d' % i for i in range(n)]
+    addrs = ['127.0.0.1:%d' % (args.base_port + i) for i in range(n)]
+    extra_args = ['-m', mode, '-o', args.order, '-b', str(args.batch_size)]
+    processes = [run_peer(args.impl_dir, names[i], addrs[i], addrs, TEST_SERVER_ADDR, args.debug, extra_args)
+                 for i in range(n)]
+    try:
+        if not ts.wait_processes(n, args.startup):
+            logging.error("Startup timeout for %d peers", n)
+            return None
+        ts.set_real_time_mode(True)
+        ts.set_message_drop_rate(args.drop)
+        ts.set_message_delay(args.min_delay, args.max_delay)
+        ts.set_event_reordering(args.reorder)
+
+        alive = list(names)
+        # падения равномерно распределяем по времени рассылки
+        crash_at = set(args.messages * (k + 1) // (args.crashes + 1) for k in range(args.crashes))
+        for i in range(args.messages):
+            if i in crash_at and len(alive) > 1:
+                crashed = random.choice(alive)
+                ts.crash_process(crashed)
+                alive.remove(crashed)
+            ts.send_local_message(random.choice(alive), Message('SEND', 'msg%d' % i))
+            time.sleep(args.gap)
+
+        # ждём, пока живые пиры доставят всё, что смогут, и снимаем счётчики
+        counts = dict((peer, 0) for peer in alive)
+        stats = dict()
+        deadline = time.time() + args.wait
+        while time.time() < deadline and min(counts.values()) < args.messages:
+            collect(ts, alive, counts, dict(), 0)
+            time.sleep(0.1)
+        for peer in alive:
+            ts.send_local_message(peer, Message('STATS'))
+        collect(ts, alive, counts, stats, 1)
+        return summarize(n, mode, args.messages, counts, stats)
+    finally:
+        for proc in processes:
+            proc.terminate()
+        ts.stop()
+        for proc in processes:
+            proc.kill()
+
+
+def summarize(n, mode, messages, counts, stats):
+    sent = sum(sum(s['sent'].values()) for s in stats.values())
+    payload = sum(s['sent'].get('BCAST', 0) + s['sent'].get('BATCH', 0) for s in stats.values())
+    broadcasts = max(1, sum(s['broadcasts'] for s in stats.values()))
+    latencies = [latency for s in stats.values() for latency in s['latencies']]
+    rss = [s['max_rss_kb'] for s in stats.values()] or [0]
+    return {
+        'peers': n,
+        'mode': mode,
+        'delivered': '%d/%d' % (min(counts.values()), messages),
+        'msgs/bcast': sent / broadcasts,
+        'payload/bcast': payload / broadcasts,
+        'p50 ms': percentile(latencies, 50) * 1000,
+        'p90 ms': percentile(latencies, 90) * 1000,
+        'p99 ms': percentile(latencies, 99) * 1000,
+        'hold-back max': max([s['hold_back_max'] for s in stats.values()] or [0]),
+        'rss avg KB': sum(rss) / len(rss),
+        'rss max KB': max(rss),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='impl_dir', metavar='DIRECTORY',
+                        help="directory with implementation to benchmark")
+    parser.add_argument('-n', dest='sizes', default='5,10,25,50,100',
+                        help="comma-separated numbers of peers")
+    parser.add_argument('-m', dest='modes', default='relay,gossip,plumtree',
+                        help="comma-separated dissemination modes to compare")
+    parser.add_argument('-o', dest='order', default='fifo', help="delivery order passed to peers")
+    parser.add_argument('-b', dest='batch_size', type=int, default=1, help="batch size passed to peers")
+    parser.add_argument('-c', dest='messages', type=int, default=100, help="number of broadcasts")
+    parser.add_argument('--gap', type=float, default=0.01, help="pause between broadcasts (seconds)")
+    parser.add_argument('--drop', type=float, default=0, help="message drop rate")
+    parser.add_argument('--min-delay', type=float, default=0, help="minimal message delay")
+    parser.add_argument('--max-delay', type=float, default=0, help="maximal message delay")
+    parser.add_argument('--reorder', action='store_true', help="enable event reordering")
+    parser.add_argument('--crashes', type=int, default=0, help="number of peers crashed during the run")
+    parser.add_argument('--wait', type=float, default=30, help="how long to wait for delivery (seconds)")
+    parser.add_argument('--startup', type=float, default=30, help="how long to wait for peers to start (seconds)")
+    parser.add_argument('--base-port', type=int, default=9800, help="first port for peers")
+    parser.add_argument('-d', dest='debug', action='store_true',
+                        help="include debugging output from implementation")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+    results = []
+    for n in map(int, args.sizes.split(',')):
+        for mode in args.modes.split(','):
+            result = run_bench(args, n, mode)
+            if result is not None:
+                results.append(result)
+                logging.info("%s", result)
+
+    if not results:
+        return 1
+    columns = list(results[0])
+    print(' | '.join('%13s' % column for column in columns))
+    for result in results:
+        print(' | '.join('%13.1f' % value if isinstance(value, float) else '%13s' % value
+                         for value in result.values()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
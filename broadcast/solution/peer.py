@@ -3,73 +3,783 @@
 import argparse
 import collections
 import heapq
+import json
 import logging
+import math
+import os
+import queue
+import random
+import resource
+import threading
+import time
 
 from dslib import Communicator, Message
 
 
+GOSSIP_C = 1                  # добавка к log(N) для числа получателей и раундов в режиме gossip
+ANTI_ENTROPY_PERIOD = 1.0     # как часто (в секундах) отправляем дайджест случайному пиру
+HISTORY_SIZE = 1000           # сколько последних сообщений от каждого отправителя храним для повторной отправки
+BATCH_DELAY = 0.01            # сколько максимум копим сообщения в пачку для одного пира (секунды)
+NACK_DELAY = 0.05             # сколько ждём пропущенное сообщение, прежде чем запросить его (секунды)
+NACK_TIMEOUT = 0.5            # через сколько повторяем запрос, если пропуск так и не закрылся (секунды)
+NACK_MAX = 100                # сколько номеров максимум запрашиваем в одном NACK
+GRAFT_TIMEOUT = 0.5           # сколько ждём сообщение после IHAVE, прежде чем восстановить связь в дереве (plumtree)
+BACKLOG_SIZE = 10000          # сколько отложенных сообщений храним для отстающего пира, старые выбрасываем
+SYNC_WAIT = 0.2               # сколько вернувшийся пир собирает ответы SYNC_INFO перед докачкой (секунды)
+FETCH_CHUNK = 100             # сколько сообщений одного отправителя запрашиваем у одного пира за раз
+STATE_PERIOD = 0.5            # как часто сохраняем номера доставленных сообщений на диск (секунды)
+LATENCY_SAMPLES = 1000        # сколько последних задержек доставки храним для STATS
+ORDER_DELAY = 0.01            # сколько секвенсер копит назначения глобальных номеров в одно сообщение ORDER
+ORDER_BATCH = 100             # сколько максимум назначений в одном ORDER
+ORDER_HISTORY = 1000          # сколько последних принятых ORDER помним, чтобы передать их новому секвенсеру
+ORDER_TIMEOUT = 1.0           # сколько ждём ORDER от секвенсера, прежде чем сменить его (секунды)
+
+
 class Peer:
-    def __init__(self, name, addr, peers):
+    def __init__(self, name, addr, peers, mode='relay', batch_size=1, order='fifo', queue_depth=0,
+                 state_path=None, rejoin=False):
         self._name = name
+        self._addr = addr
         self._peers = peers
+        self._mode = mode                 # relay - пересылаем всем, gossip - случайным log(N)+c пирам,
+                                          # plumtree - сообщения по дереву, остальным только IHAVE
         self._comm = Communicator(name, addr)
         self._last_received = dict()      # словарь для номеров последнего полученного сообщения от каждого отправителя
         self._seq_no = 0                  # Sequence Number для последнего отправленного сообщения
-        self._received = set()            # множество всех полученных сообщений
+        self._above = dict()              # отправитель -> номера сообщений выше _last_received, ждущих в очереди
         self._hold_back_queue = dict()    # очередь сообщений для реализации порядка
-    
+        self._history = dict()            # отправитель -> {seq_no: сообщение} последних сообщений (буфер для повторов)
+        self._holders = dict()            # отправитель -> адрес пира, от которого последним пришло его сообщение
+        self._timers = dict()             # имя таймера -> время срабатывания
+        self._eager_peers = set(peer for peer in peers if peer != addr)     # рёбра дерева (plumtree)
+        self._lazy_peers = set()          # остальные пиры, им отправляем только IHAVE
+        self._missing = dict()            # (from, seq_no) -> адреса пиров, приславших IHAVE на неполученное сообщение
+        self._batch_size = batch_size     # сколько BCAST'ов отправляем одному пиру одним сообщением BATCH
+        self._outbox = dict()             # адрес пира -> ещё не отправленная пачка [[body, headers], ...]
+        self._order = order               # fifo - порядок для каждого отправителя, total - общий порядок для всех,
+                                          # causal - причинный порядок
+        self._view = 0                    # номер секвенсера: им работает sorted(peers)[view % N]
+        self._next_global = 1             # следующий глобальный номер, который назначит секвенсер
+        self._next_deliver = 1            # следующий глобальный номер, который доставим пользователю
+        self._global_order = dict()       # глобальный номер -> (from, seq_no), общая очередь для доставки
+        self._assigned = set()            # (from, seq_no), которым уже назначен глобальный номер, но они не доставлены
+        self._unordered = dict()          # (from, seq_no) -> сообщение, дошедшее по FIFO и ждущее доставки по порядку
+        self._order_batch = list()        # назначения, которые секвенсер ещё не разослал
+        self._proposals = collections.OrderedDict()  # (view, первый номер) -> [id, кто принял, принято большинством]
+        self._view_ready = True           # секвенсер текущего view собрал состояние большинства и может назначать
+        self._view_states = dict()        # новый секвенсер: адрес пира -> его принятые ORDER и неупорядоченные id
+        self._stuck = list()              # сообщения без глобального номера на прошлой проверке
+        self._delivered = dict()          # causal: отправитель -> сколько его сообщений доставлено пользователю
+        self._sent_deps = dict()          # causal: зависимости, указанные в нашем прошлом сообщении
+        self._origin_deps = dict()        # causal: отправитель -> полные зависимости его последнего сообщения
+        self._waiting = dict()            # causal: (отправитель, номер) -> сообщения, ждущие доставки этого номера
+        self._queue_depth = queue_depth   # размер очереди на отправку каждому пиру, 0 - отправляем сразу из run
+        self._outbound = dict()           # адрес пира -> очередь сообщений, которую разбирает поток отправки
+        self._ready = queue.Queue()       # для потока отправки: (пир, None) - в очереди пира есть сообщение,
+                                          # (None, сообщение) - локальная доставка; Communicator трогает только он
+        self._backlog = dict()            # адрес пира -> отложенные сообщения, не влезшие в его очередь
+        self._lagging = collections.Counter()  # адрес пира -> сколько сообщений ему пришлось отложить
+        self._dropped = collections.Counter()  # адрес пира -> сколько отложенных сообщений выбросили
+        self._state_path = state_path     # файл, куда сохраняем свой seq_no и _last_received
+        self._state_dirty = False
+        self._sync_infos = dict()         # адрес пира -> (его digest, самый старый номер в его истории по отправителям)
+        self._sent = collections.Counter()                            # тип сообщения -> сколько отправили
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)   # задержки от SEND до DELIVER (секунды)
+        self._delivered_count = 0
+        self._hold_back_max = 0           # наибольшая длина очереди hold-back за всё время
+
+        self._fanout = min(len(peers) - 1, math.ceil(math.log(len(peers))) + GOSSIP_C)
+        self._rounds = math.ceil(math.log(len(peers))) + GOSSIP_C
+        # дайджест нужен во всех режимах: NACK чинит только дыры перед более поздними номерами, а последнее
+        # сообщение отправителя (или потерянные и сообщение по дереву, и IHAVE в plumtree) досылает только он
+        self.set_timer('antiEntropy', ANTI_ENTROPY_PERIOD)
+        if self._order == 'total':
+            self.set_timer('orderCheck', ORDER_TIMEOUT)
+        if self._state_path is not None:
+            if os.path.exists(self._state_path):
+                self.load_state()
+                rejoin = True
+            self.set_timer('saveState', STATE_PERIOD)
+        if rejoin:
+            # мы перезапустились: узнаём у всех, что пропустили, и докачиваем недостающее
+            for peer in self.others():
+                self.send(Message('SYNC_REQ', self.digest()), peer)
+            self.set_timer('syncPlan', SYNC_WAIT)
+
     def run(self):
         while True:
-            msg = self._comm.recv()
+            msg = self._comm.recv(timeout=self.next_timeout())
+            self.fire_timers()
+            if msg is None:
+                continue
 
             # local user wants to send a message to the chat
             if msg.type == 'SEND' and msg.is_local():
                 # basic broadcast
                 self._seq_no += 1
+                self._state_dirty = True          # иначе после перезапуска отправим новые сообщения со старыми номерами
                 bcast_msg = Message('BCAST', msg.body, {'from': self._name, 'seq_no': self._seq_no,
-                                                        'sender': self._name})          # будем добавлять имя процесса,
-                                                                                        # который отправил сообщение
-                for peer in self._peers:
-                    self._comm.send(bcast_msg, peer)
+                                                        'sender': self._name,           # будем добавлять имя процесса,
+                                                        'round': 0,                     # который отправил сообщение
+                                                        'sent_at': time.time()})
+                if self._order == 'causal':
+                    bcast_msg.headers['deps'] = self.deps_delta()
+                if self._mode == 'gossip':
+                    # в gossip сами себе не отправляем - сразу доставляем и рассылаем случайным пирам
+                    self.remember(bcast_msg)
+                    self.gossip(bcast_msg)
+                    self.deliver(bcast_msg)
+                elif self._mode == 'plumtree':
+                    self.remember(bcast_msg)
+                    self.tree_push(bcast_msg, None)
+                    self.deliver(bcast_msg)
+                else:
+                    self.remember(bcast_msg)
+                    for peer in self._peers:
+                        self.send_bcast(bcast_msg, peer)
+
+            # счётчики для бенчмарка
+            elif msg.type == 'STATS' and msg.is_local():
+                self.send_local(Message('STATS', self.stats()))
 
             # received broadcasted message
             elif msg.type == 'BCAST':
-                # deliver message to the local user
+                self.on_bcast(msg, msg.sender)
+
+            # пачка BCAST'ов - каждый обрабатываем так же, как отдельное сообщение
+            elif msg.type == 'BATCH':
+                for body, headers in msg.body:
+                    self.on_bcast(Message('BCAST', body, headers), msg.sender)
+
+            # пир прислал, сколько сообщений от каждого отправителя он уже доставил
+            elif msg.type == 'DIGEST':
+                self.anti_entropy(msg)
+
+            # total: секвенсер назначил глобальные номера пачке сообщений
+            elif msg.type == 'ORDER':
+                self.on_order(msg.body, msg.sender)
+
+            # total: пир перешёл в наш view и сообщает, что он уже принял
+            elif msg.type == 'VIEW_STATE':
+                self.on_view_state(msg.body, msg.sender)
+
+            # total: кто-то не дождался ORDER и перешёл к следующему секвенсеру
+            elif msg.type == 'VIEW':
+                if msg.body > self._view:
+                    self.change_sequencer(msg.body)
+                    for peer in self.others():
+                        if peer != msg.sender:
+                            self.send(msg, peer)
+
+            # пир перезапустился и спрашивает, что он пропустил
+            elif msg.type == 'SYNC_REQ':
+                low = {origin: next(iter(history)) for origin, history in self._history.items() if history}
+                self.send(Message('SYNC_INFO', [self.digest(), low]), msg.sender)
+
+            elif msg.type == 'SYNC_INFO':
+                digest, low = msg.body
+                self._sync_infos[msg.sender] = (digest, low)
+                # свои старые номера тоже узнаём от других, чтобы не отправить новое сообщение со старым номером
+                if digest.get(self._name, 0) > self._seq_no:
+                    self._seq_no = digest[self._name]
+                    self._state_dirty = True
+
+            # пир докачивает у нас кусок пропущенных сообщений
+            elif msg.type == 'FETCH':
+                origin, first, last = msg.body
+                history = self._history.get(origin, dict())
+                for seq_no in range(first, last + 1):
+                    if seq_no in history:
+                        self.resend(origin, seq_no, msg.sender)
+
+            # пир просит повторить сообщения, которых ему не хватает
+            elif msg.type == 'NACK':
+                origin, missing = msg.body
+                for seq_no in missing:
+                    if seq_no in self._history.get(origin, dict()):
+                        self.resend(origin, seq_no, msg.sender)
+
+            # plumtree: у пира есть сообщение (from, seq_no), которое нам не пришло по дереву
+            elif msg.type == 'IHAVE':
+                origin, seq_no = msg.body
+                if not self.seen(origin, seq_no):
+                    self._missing.setdefault((origin, seq_no), list()).append(msg.sender)
+                    if 'graft:%s:%d' % (origin, seq_no) not in self._timers:
+                        self.set_timer('graft:%s:%d' % (origin, seq_no), GRAFT_TIMEOUT)
+
+            # plumtree: пир получает от нас сообщения дважды - больше не шлём ему их целиком
+            elif msg.type == 'PRUNE':
+                self._eager_peers.discard(msg.sender)
+                self._lazy_peers.add(msg.sender)
+
+            # plumtree: пир не дождался сообщения - возвращаем ребро в дерево и досылаем сообщение
+            elif msg.type == 'GRAFT':
+                origin, seq_no = msg.body
+                self._lazy_peers.discard(msg.sender)
+                self._eager_peers.add(msg.sender)
+                if seq_no in self._history.get(origin, dict()):
+                    self.send_bcast(self._history[origin][seq_no], msg.sender)
+
+    def send(self, msg, peer):
+        self._sent[msg.type] += 1
+        if self._queue_depth <= 0:
+            self._comm.send(msg, peer)
+            return
+        if not self._outbound:
+            threading.Thread(target=self.drain, daemon=True).start()
+        if peer not in self._outbound:
+            self._outbound[peer] = queue.Queue(maxsize=self._queue_depth)
+        # run никогда не ждёт: если пир не успевает разбирать очередь, он отстаёт - сообщения ему откладываем
+        # и досылаем по таймеру, когда место освободится (порядок сохраняется: пока есть отложенные, новые - за ними)
+        if self._backlog.get(peer) or not self.enqueue(msg, peer):
+            self.defer(msg, peer)
+
+    def enqueue(self, msg, peer):
+        # копия: основной поток дальше меняет заголовки того же сообщения
+        try:
+            self._outbound[peer].put_nowait(Message(msg.type, msg.body, dict(msg.headers or {})))
+        except queue.Full:
+            return False
+        self._ready.put((peer, None))
+        return True
+
+    def send_local(self, msg):
+        # с очередями пользователю отдаёт тот же поток отправки: run с ним за Communicator не соревнуется
+        if self._queue_depth <= 0:
+            self._comm.send_local(msg)
+        else:
+            self._ready.put((None, msg))
+
+    def defer(self, msg, peer):
+        # BCAST'ы откладываем только номерами (и раундом) - сами сообщения потом возьмём из _history
+        if peer not in self._backlog:
+            logging.warning('outbound queue to %s is full, peer is lagging', peer)
+        backlog = self._backlog.setdefault(peer, collections.deque())
+        if msg.type == 'BCAST':
+            backlog.append((msg.headers['from'], msg.headers['seq_no'], msg.headers['round']))
+        elif msg.type == 'BATCH':
+            backlog.extend((headers['from'], headers['seq_no'], headers['round']) for body, headers in msg.body)
+        else:
+            backlog.append(Message(msg.type, msg.body, dict(msg.headers or {})))
+        self._lagging[peer] += 1
+        while len(backlog) > BACKLOG_SIZE:
+            # пир, видимо, упал: дальше не копим, выброшенное он после возвращения докачает через SYNC/NACK
+            backlog.popleft()
+            self._dropped[peer] += 1
+        if 'refill:' + peer not in self._timers:
+            self.set_timer('refill:' + peer, BATCH_DELAY)
+
+    def refill(self, peer):
+        backlog = self._backlog[peer]
+        while backlog:
+            item = backlog[0]
+            if isinstance(item, tuple):
+                origin, seq_no, round_no = item
+                resend = self._history.get(origin, dict()).get(seq_no)
+                if resend is None:
+                    # уже вытеснено из истории - пир сам запросит пропуск через NACK
+                    backlog.popleft()
+                    continue
+                # отложенное - не досылка: раунд прежний, иначе получатели не перешлют его дальше
+                item = Message('BCAST', resend.body, dict(resend.headers, sender=self._name, round=round_no))
+            if not self.enqueue(item, peer):
+                self.set_timer('refill:' + peer, BATCH_DELAY)
+                return
+            backlog.popleft()
+        del self._backlog[peer]
+
+    def drain(self):
+        # единственный поток, который отправляет: run только кладёт сообщения в очереди и никогда не ждёт,
+        # а пирам отправляем по очереди, в порядке поступления сообщений
+        while True:
+            peer, msg = self._ready.get()
+            if peer is None:
+                self._comm.send_local(msg)
+            else:
+                self._comm.send(self._outbound[peer].get_nowait(), peer)
+
+    def on_bcast(self, msg, sender):
+        self._holders[msg.headers['from']] = sender
+        if self._mode == 'plumtree':
+            self.tree_receive(msg, sender)
+            return
+
+        # deliver message to the local user
+
+        # если сообщение уже обработали, то снова обрабатывать его не будем;
+        # сообщение определяется отправителем и его номером, а не текстом
+        if not self.seen(msg.headers['from'], msg.headers['seq_no']) and (msg.headers['sender'] != self._name):
+            self.remember(msg)
+
+            if self._mode == 'gossip':
+                self.gossip(msg)
+            elif msg.headers['from'] != self._name and msg.headers['round'] < self._rounds:
+                # досланное по FETCH/NACK получатель только доставляет: остальным его досылают их собственные запросы
+                msg.headers['sender'] = self._name
+                for peer in self._peers:              # после получения сообщения отправим его всем другим
+                    self.send_bcast(msg, peer)
+
+            self.deliver(msg)
+
+    def resend(self, origin, seq_no, peer):
+        # копия с round = _rounds: досланное дальше не распространяется, а сообщение в истории не меняем
+        msg = self._history[origin][seq_no]
+        self.send_bcast(Message('BCAST', msg.body, dict(msg.headers, sender=self._name, round=self._rounds)), peer)
+
+    def send_bcast(self, msg, peer):
+        if self._batch_size <= 1:
+            self.send(msg, peer)
+            return
+        # заголовки копируем: одно и то же сообщение потом пересылается с другими заголовками
+        self._outbox.setdefault(peer, list()).append([msg.body, dict(msg.headers)])
+        if len(self._outbox[peer]) >= self._batch_size:
+            self.flush(peer)
+        elif 'flush:' + peer not in self._timers:
+            self.set_timer('flush:' + peer, BATCH_DELAY)
+
+    def flush(self, peer):
+        self.cancel_timer('flush:' + peer)
+        batch = self._outbox.pop(peer, None)
+        if batch:
+            self.send(Message('BATCH', batch), peer)
+
+    def deliver(self, msg):
+        # проверка порядка
+        if msg.headers['seq_no'] == (self._last_received.setdefault(msg.headers['from'], 0) + 1):
+
+            self.deliver_local(msg)
+            self._last_received[msg.headers['from']] += 1
+            self._state_dirty = True
+            self.release(msg.headers['from'])
+
+        # если N-ое сообщение пришло быстрее, чем предыдущее, то не обрабатываем его, а добавляем в очередь
+        elif msg.headers['seq_no'] > (self._last_received.setdefault(msg.headers['from'], 0) + 1):
+            heapq.heappush(self._hold_back_queue.setdefault(msg.headers['from'], list()), tuple((msg.headers['seq_no'], msg)))
+            self._hold_back_max = max(self._hold_back_max, len(self._hold_back_queue[msg.headers['from']]))
+            self._above.setdefault(msg.headers['from'], set()).add(msg.headers['seq_no'])
+            # появился пропуск - если он не закроется сам, запросим недостающее
+            if 'nack:' + msg.headers['from'] not in self._timers:
+                self.set_timer('nack:' + msg.headers['from'], NACK_DELAY)
+
+    def release(self, origin):
+        # чистим очередь
+        while self._hold_back_queue.setdefault(origin, list()):
+            if self._hold_back_queue[origin][0][0] == (self._last_received[origin] + 1):
+
+                # отправляем сообщения из очереди последовательно (по порядку)
+                next_msg = (heapq.heappop(self._hold_back_queue[origin]))[1]
+                self._above[origin].discard(next_msg.headers['seq_no'])
+                self.deliver_local(next_msg)
+                self._last_received[origin] += 1
+
+            elif self._hold_back_queue[origin][0][0] <= self._last_received[origin]:
+                # сообщение старше точки, до которой мы перескочили при восстановлении
+                self._above[origin].discard(heapq.heappop(self._hold_back_queue[origin])[0])
+
+            else:             # если в очереди нет следующего сообщения, ничего не делаем
+                break
+
+    def skip_to(self, origin, seq_no):
+        # сообщений до seq_no ни у кого уже нет: считаем их пропущенными и доставляем то, что лежит за ними
+        if seq_no <= self._last_received.get(origin, 0):
+            return
+        self._last_received[origin] = seq_no
+        self._state_dirty = True
+        if self._order == 'causal':
+            self._delivered[origin] = max(self._delivered.get(origin, 0), seq_no)
+            self._origin_deps.pop(origin, None)
+            ready = list()
+            for origin_count in [key for key in self._waiting if key[0] == origin and key[1] <= seq_no]:
+                ready.extend(self._waiting.pop(origin_count))
+            self.release_causal(ready)
+        self.release(origin)
+
+    def deliver_local(self, msg):
+        if self._order == 'fifo':
+            self.deliver_user(msg)
+            return
+        if self._order == 'causal':
+            self.deliver_causal(msg)
+            return
+        # total: сообщение дошло в порядке отправителя, теперь ждём его глобальный номер
+        msg_id = (msg.headers['from'], msg.headers['seq_no'])
+        self._unordered[msg_id] = msg
+        if self.is_sequencer():
+            self.assign(msg_id)
+        self.deliver_total()
+
+    def deps_delta(self):
+        # в сообщение кладём только изменившиеся с нашего прошлого сообщения компоненты векторных часов:
+        # получатели обрабатывают наши сообщения по порядку и восстанавливают вектор целиком
+        delta = {origin: count for origin, count in self._delivered.items()
+                 if origin != self._name and self._sent_deps.get(origin, 0) != count}
+        self._sent_deps = dict(self._delivered)
+        return delta
+
+    def deliver_user(self, msg):
+        deliver_msg = Message('DELIVER', msg.headers['from'] + ': ' + msg.body)
+        self.send_local(deliver_msg)
+        self._delivered_count += 1
+        if 'sent_at' in msg.headers:
+            self._latencies.append(time.time() - msg.headers['sent_at'])
+
+    def stats(self):
+        return {'sent': dict(self._sent),
+                'broadcasts': self._seq_no,
+                'delivered': self._delivered_count,
+                'latencies': list(self._latencies),
+                'hold_back_max': self._hold_back_max,
+                'lagging': dict(self._lagging),
+                'dropped': dict(self._dropped),
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    def deliver_causal(self, msg):
+        # сообщения отправителя приходят сюда по порядку, поэтому можно накладывать разницу на прошлый вектор
+        origin = msg.headers['from']
+        deps = self._origin_deps.setdefault(origin, dict())
+        deps.update(msg.headers.get('deps', dict()))
+        full_deps = dict(deps)
+        full_deps[origin] = msg.headers['seq_no'] - 1
+        self.release_causal([(msg, full_deps)])
+
+    def release_causal(self, ready):
+        while ready:
+            msg, deps = ready.pop()
+            missing = next(((origin, count) for origin, count in deps.items()
+                            if self._delivered.get(origin, 0) < count), None)
+            if missing is not None:
+                # ждём доставки одной недостающей зависимости; когда она придёт, проверим остальные
+                self._waiting.setdefault(missing, list()).append((msg, deps))
+                continue
+            self.deliver_user(msg)
+            self._delivered[msg.headers['from']] = msg.headers['seq_no']
+            ready.extend(self._waiting.pop((msg.headers['from'], msg.headers['seq_no']), list()))
+
+    def load_state(self):
+        with open(self._state_path) as f:
+            state = json.load(f)
+        self._seq_no = state['seq_no']
+        self._last_received = state['last_received']
+
+    def save_state(self):
+        # пишем во временный файл и подменяем, чтобы при падении не остаться с наполовину записанным файлом
+        with open(self._state_path + '.tmp', 'w') as f:
+            json.dump({'seq_no': self._seq_no, 'last_received': self._last_received}, f)
+        os.replace(self._state_path + '.tmp', self._state_path)
+        self._state_dirty = False
+
+    def plan_fetch(self):
+        # делим недостающие диапазоны на куски и запрашиваем их у разных пиров параллельно
+        origins = set()
+        for digest, low in self._sync_infos.values():
+            origins.update(digest)
+        for origin in origins:
+            start = self._last_received.get(origin, 0) + 1
+            end = max(digest.get(origin, 0) for digest, low in self._sync_infos.values())
+            if end < start:
+                continue
+            truncated = min(low.get(origin, end + 1) for digest, low in self._sync_infos.values())
+            if truncated > start:
+                self.skip_to(origin, truncated - 1)
+                start = truncated
+            for i, chunk_start in enumerate(range(start, end + 1, FETCH_CHUNK)):
+                chunk_end = min(chunk_start + FETCH_CHUNK - 1, end)
+                holders = [peer for peer, (digest, low) in self._sync_infos.items()
+                           if digest.get(origin, 0) >= chunk_end and low.get(origin, end + 1) <= chunk_start]
+                if not holders:
+                    holders = [peer for peer, (digest, low) in self._sync_infos.items()
+                               if digest.get(origin, 0) >= chunk_start]
+                self.send(Message('FETCH', [origin, chunk_start, chunk_end]), holders[i % len(holders)])
+        self._sync_infos.clear()
+
+    def sequencer(self):
+        return sorted(self._peers)[self._view % len(self._peers)]
+
+    def is_sequencer(self):
+        return self.sequencer() == self._addr
+
+    def majority(self):
+        return len(self._peers) // 2 + 1
+
+    def assign(self, msg_id):
+        if not self._view_ready:
+            return                                    # новый секвенсер ещё не собрал состояние большинства
+        self._order_batch.append(list(msg_id))
+        if len(self._order_batch) >= ORDER_BATCH:
+            self.send_order()
+        elif 'order' not in self._timers:
+            self.set_timer('order', ORDER_DELAY)
+
+    def send_order(self):
+        self.cancel_timer('order')
+        if not self._order_batch:
+            return
+        self.propose(self._next_global, self._order_batch)
+        self._next_global += len(self._order_batch)
+        self._order_batch = list()
+
+    def propose(self, first, ids):
+        body = [self._view, first, ids]
+        self.on_order(body, self._addr)
+        for peer in self.others():
+            self.send(Message('ORDER', body), peer)
+
+    def on_order(self, body, sender):
+        view, first, ids = body
+        if view < self._view:
+            return                                    # ORDER прежнего секвенсера после смены не принимаем
+        if view > self._view:
+            self.change_sequencer(view)               # VIEW до нас не дошёл
+        key = (view, first)
+        if key not in self._proposals:
+            self._proposals[key] = [ids, set([self._addr]), False]
+            if len(self._proposals) > ORDER_HISTORY:
+                self._proposals.popitem(last=False)
+            if sender != self._addr:
+                # пересылаем ORDER всем, и секвенсеру тоже: так каждый узнаёт, сколько пиров его приняли
+                for peer in self.others():
+                    self.send(Message('ORDER', body), peer)
+        proposal = self._proposals[key]
+        proposal[1].add(sender)
+        # назначение окончательно, когда его приняло большинство: тогда о нём узнает любой следующий секвенсер
+        if not proposal[2] and len(proposal[1]) >= self.majority():
+            proposal[2] = True
+            for i, msg_id in enumerate(ids):
+                if first + i >= self._next_deliver and first + i not in self._global_order:
+                    self._global_order[first + i] = None if msg_id is None else tuple(msg_id)
+                    if msg_id is not None:
+                        self._assigned.add(tuple(msg_id))
+            self.deliver_total()
+
+    def deliver_total(self):
+        # общая очередь: доставляем по глобальным номерам подряд, пока есть и номер, и само сообщение
+        while self._next_deliver in self._global_order:
+            msg_id = self._global_order[self._next_deliver]
+            if msg_id is None:
+                pass                                  # пустой номер: его никто не назначил до смены секвенсера
+            elif msg_id in self._unordered:
+                msg = self._unordered.pop(msg_id)
+                self._assigned.discard(msg_id)
+                self.deliver_user(msg)
+            elif msg_id[1] > self._last_received.get(msg_id[0], 0):
+                break                                 # самого сообщения ещё нет
+            # иначе после смены секвенсера сообщению достался второй номер - оно уже доставлено, пропускаем
+            del self._global_order[self._next_deliver]
+            self._next_deliver += 1
+
+    def change_sequencer(self, view):
+        # новый секвенсер ничего не назначает, пока большинство не пришлёт ему принятые назначения
+        # и неупорядоченные сообщения: иначе он может раздать номера, уже выданные прежним секвенсером
+        self._view = view
+        self._view_ready = False
+        self._view_states = dict()
+        self._order_batch = list()
+        self.cancel_timer('order')
+        proposals = [[v, first, ids] for (v, first), (ids, acks, stable) in self._proposals.items()]
+        unordered = [list(msg_id) for msg_id in self._unordered if msg_id not in self._assigned]
+        state = [view, proposals, self._next_deliver, unordered]
+        if self.is_sequencer():
+            self.on_view_state(state, self._addr)
+        else:
+            self.send(Message('VIEW_STATE', state), self.sequencer())
+
+    def on_view_state(self, body, sender):
+        view, proposals, next_deliver, unordered = body
+        if view != self._view or not self.is_sequencer() or self._view_ready:
+            return
+        self._view_states[sender] = body
+        if len(self._view_states) >= self.majority():
+            self.start_view()
+
+    def start_view(self):
+        # на каждый номер берём назначение из самого позднего view: если номер где-то доставлен,
+        # его приняло большинство, а значит, он есть хотя бы в одном из собранных ответов
+        chosen = dict()                               # глобальный номер -> (view, id)
+        next_global = 1
+        pending = set()
+        for view, proposals, next_deliver, unordered in self._view_states.values():
+            next_global = max(next_global, next_deliver)
+            pending.update(tuple(msg_id) for msg_id in unordered)
+            for v, first, ids in proposals:
+                for i, msg_id in enumerate(ids):
+                    if first + i not in chosen or chosen[first + i][0] < v:
+                        chosen[first + i] = (v, msg_id)
+        self._view_ready = True
+        self._view_states = dict()
+        if chosen:
+            # заново предлагаем в новом view всё, что знает большинство; дыры заполняем пустыми номерами
+            numbers = range(min(chosen), max(chosen) + 1)
+            ids = [chosen[g][1] if g in chosen else None for g in numbers]
+            for i in range(0, len(ids), ORDER_BATCH):
+                self.propose(numbers[0] + i, ids[i:i + ORDER_BATCH])
+            next_global = max(next_global, numbers[-1] + 1)
+            pending -= set(tuple(msg_id) for v, msg_id in chosen.values() if msg_id is not None)
+        self._next_global = next_global
+        pending.update(msg_id for msg_id in self._unordered if msg_id not in self._assigned)
+        for msg_id in sorted(pending):
+            self.assign(msg_id)
+
+    def remember(self, msg):
+        history = self._history.setdefault(msg.headers['from'], collections.OrderedDict())
+        history[msg.headers['seq_no']] = msg
+        if len(history) > HISTORY_SIZE:
+            history.popitem(last=False)
+
+    def others(self):
+        return [peer for peer in self._peers if peer != self._addr]
+
+    def gossip(self, msg):
+        # пересылаем сообщение log(N)+c случайным пирам, пока не кончились раунды
+        if msg.headers['round'] >= self._rounds:
+            return
+        msg.headers['sender'] = self._name
+        msg.headers['round'] += 1
+        for peer in random.sample(self.others(), self._fanout):
+            self.send_bcast(msg, peer)
+
+    def seen(self, origin, seq_no):
+        # всё до _last_received уже доставлено, а выше него помним только то, что лежит в очереди
+        return seq_no <= self._last_received.get(origin, 0) or seq_no in self._above.get(origin, ())
+
+    def tree_push(self, msg, came_from):
+        msg.headers['sender'] = self._name
+        for peer in self._eager_peers:
+            if peer != came_from:
+                self.send_bcast(msg, peer)
+        ihave = Message('IHAVE', [msg.headers['from'], msg.headers['seq_no']])
+        for peer in self._lazy_peers:
+            if peer != came_from:
+                self.send(ihave, peer)
+
+    def tree_receive(self, msg, sender):
+        origin, seq_no = msg.headers['from'], msg.headers['seq_no']
+        if msg.headers['round'] >= self._rounds:
+            # досланное по дайджесту пришло не по дереву: дерево не трогаем и дальше не рассылаем
+            if not self.seen(origin, seq_no):
+                self._missing.pop((origin, seq_no), None)
+                self.cancel_timer('graft:%s:%d' % (origin, seq_no))
+                self.remember(msg)
+                self.deliver(msg)
+            return
+        if self.seen(origin, seq_no):
+            # дубликат: ребро лишнее, убираем его из дерева
+            self._eager_peers.discard(sender)
+            self._lazy_peers.add(sender)
+            self.send(Message('PRUNE'), sender)
+            return
+        self._missing.pop((origin, seq_no), None)
+        self.cancel_timer('graft:%s:%d' % (origin, seq_no))
+        self._lazy_peers.discard(sender)
+        self._eager_peers.add(sender)
+        self.remember(msg)
+        self.tree_push(msg, sender)
+        self.deliver(msg)
+
+    def missing(self, origin):
+        above = self._above.get(origin)
+        if not above:
+            return list()
+        missing = list()
+        for seq_no in range(self._last_received.get(origin, 0) + 1, max(above)):
+            if seq_no not in above:
+                missing.append(seq_no)
+                if len(missing) == NACK_MAX:
+                    break
+        return missing
+
+    def digest(self):
+        # свои сообщения тоже по доставленным: в relay отправитель доставляет своё, только когда его вернёт другой пир
+        return dict(self._last_received)
+
+    def anti_entropy(self, msg):
+        mine = self.digest()
+        # досылаем то, чего у пира нет, а у нас есть в истории
+        for origin, last in mine.items():
+            for seq_no in range(msg.body.get(origin, 0) + 1, last + 1):
+                if seq_no in self._history.get(origin, dict()):
+                    self.resend(origin, seq_no, msg.sender)
+        # если пир знает больше нас - просим его прислать недостающее (push-pull), но только один раз
+        if not (msg.headers or {}).get('reply') and any(last > mine.get(origin, 0) for origin, last in msg.body.items()):
+            self.send(Message('DIGEST', mine, {'reply': True}), msg.sender)
+
+    def set_timer(self, name, delay):
+        self._timers[name] = time.monotonic() + delay
+
+    def cancel_timer(self, name):
+        self._timers.pop(name, None)
+
+    def next_timeout(self):
+        if not self._timers:
+            return None
+        return max(0, min(self._timers.values()) - time.monotonic())
+
+    def fire_timers(self):
+        now = time.monotonic()
+        for name, deadline in list(self._timers.items()):
+            if deadline <= now:
+                del self._timers[name]
+                self.on_timer(name)
+
+    def on_timer(self, timer):
+        if timer == 'antiEntropy':
+            if len(self.others()) > 0:
+                self.send(Message('DIGEST', self.digest(), {}), random.choice(self.others()))
+            self.set_timer('antiEntropy', ANTI_ENTROPY_PERIOD)
 
-                # если сообщение уже обработали, то снова обрабатывать его не будем
-                if (msg.body not in self._received) and (msg.headers['sender'] != self._name):
-                    self._received.add(msg.body)
+        elif timer.startswith('nack:'):
+            origin = timer[len('nack:'):]
+            missing = self.missing(origin)
+            if missing:
+                # сначала спрашиваем того, кто прислал более позднее сообщение, потом - случайных пиров
+                peer = self._holders.pop(origin, None) or random.choice(self.others())
+                self.send(Message('NACK', [origin, missing]), peer)
+                self.set_timer(timer, NACK_TIMEOUT)
 
-                    if msg.headers['from'] != self._name:
-                        msg.headers['sender'] = self._name
-                        for peer in self._peers:              # после получения сообщения отправим его всем другим
-                            self._comm.send(msg, peer)
+        elif timer == 'saveState':
+            if self._state_dirty:
+                self.save_state()
+            self.set_timer('saveState', STATE_PERIOD)
 
-                    # проверка порядка
-                    if msg.headers['seq_no'] == (self._last_received.setdefault(msg.headers['from'], 0) + 1):
+        elif timer.startswith('refill:'):
+            self.refill(timer[len('refill:'):])
 
-                        deliver_msg = Message('DELIVER', msg.headers['from'] + ': ' + msg.body)
-                        self._comm.send_local(deliver_msg)
-                        self._last_received[msg.headers['from']] += 1
+        elif timer == 'syncPlan':
+            self.plan_fetch()
 
-                        # чистим очередь
-                        while self._hold_back_queue.setdefault(msg.headers['from'], list()):
-                            if self._hold_back_queue[msg.headers['from']][0][0] == \
-                                    (self._last_received[msg.headers['from']] + 1):
+        elif timer == 'order':
+            self.send_order()
 
-                                # отправляем сообщения из очереди последовательно (по порядку)
-                                next_msg = (heapq.heappop(self._hold_back_queue[msg.headers['from']]))[1]
-                                deliver_msg = Message('DELIVER', next_msg.headers['from'] +
-                                                      ': ' + next_msg.body)
-                                self._comm.send_local(deliver_msg)
-                                self._last_received[msg.headers['from']] += 1
+        elif timer == 'orderCheck':
+            # есть сообщения, которые давно не доставлены по общему порядку - секвенсер, видимо, упал
+            # (или его ORDER не дошёл до большинства)
+            stuck = list(self._unordered)
+            # ORDER текущего view, не набравшие большинства, повторяем: копии могли потеряться
+            for (view, first), (ids, acks, stable) in self._proposals.items():
+                if view == self._view and not stable:
+                    for peer in self.others():
+                        self.send(Message('ORDER', [view, first, ids]), peer)
+            if set(stuck) & set(self._stuck):
+                self.change_sequencer(self._view + 1)
+                for peer in self.others():
+                    self.send(Message('VIEW', self._view), peer)
+            self._stuck = stuck
+            self.set_timer('orderCheck', ORDER_TIMEOUT)
 
-                            else:             # если в очереди нет следующего сообщения, ничего не делаем
-                                break
+        elif timer.startswith('flush:'):
+            self.flush(timer[len('flush:'):])
 
-                    # если N-ое сообщение пришло быстрее, чем предыдущее, то не обрабатываем его, а добавляем в очередь
-                    elif msg.headers['seq_no'] > (self._last_received.setdefault(msg.headers['from'], 0) + 1):
-                        heapq.heappush(self._hold_back_queue.setdefault(msg.headers['from'], list()), tuple((msg.headers['seq_no'], msg)))
+        elif timer.startswith('graft:'):
+            _, origin, seq_no = timer.rsplit(':', 2)
+            announcers = self._missing.get((origin, int(seq_no)))
+            if announcers:
+                # просим сообщение у первого объявившего его пира; если и он не ответит - у следующего
+                peer = announcers.pop(0)
+                self._lazy_peers.discard(peer)
+                self._eager_peers.add(peer)
+                self.send(Message('GRAFT', [origin, int(seq_no)]), peer)
+                self.set_timer(timer, GRAFT_TIMEOUT)
+            else:
+                self._missing.pop((origin, int(seq_no)), None)
 
 
 def main():
@@ -80,12 +790,25 @@ def main():
                         help='listen on specified address', default='127.0.0.1:9701')
     parser.add_argument('-p', dest='peers', 
                         help='comma separated list of peers', default='127.0.0.1:9701,127.0.0.1:9702')
+    parser.add_argument('-m', dest='mode', choices=['relay', 'gossip', 'plumtree'],
+                        help='dissemination mode', default='relay')
+    parser.add_argument('-b', dest='batch_size', type=int,
+                        help='max number of broadcasts sent to a peer in one batch', default=1)
+    parser.add_argument('-o', dest='order', choices=['fifo', 'total', 'causal'],
+                        help='delivery order', default='fifo')
+    parser.add_argument('-q', dest='queue_depth', type=int,
+                        help='per-peer outbound queue depth, 0 to send synchronously', default=0)
+    parser.add_argument('-s', dest='state_path', metavar='path',
+                        help='file to persist delivery watermarks, peer catches up from it after restart', default=None)
+    parser.add_argument('-r', dest='rejoin', action='store_true',
+                        help='catch up with other peers on start even without saved state')
     parser.add_argument('-d', dest='log_level', action='store_const', const=logging.DEBUG,
                         help='print debugging info', default=logging.WARNING)
     args = parser.parse_args()
     logging.basicConfig(format="%(asctime)s - %(message)s", level=args.log_level)
 
-    peer = Peer(args.name, args.addr, args.peers.split(','))
+    peer = Peer(args.name, args.addr, args.peers.split(','), args.mode, args.batch_size, args.order, args.queue_depth,
+                args.state_path, args.rejoin)
     peer.run()
 
 
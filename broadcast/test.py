@@ -4,9 +4,12 @@ import argparse
 import logging
 import os
 import random
+import shutil
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 import unittest
 
 from dslib.message import Message
@@ -17,10 +20,11 @@ PEER_NAMES = ['Alice', 'Bob', 'Carl', 'Dan', 'Eve']
 TEST_SERVER_ADDR = '127.0.0.1:9746'
 
 
-def run_peer(impl_dir, name, addr, peer_list, ts_addr, debug):
+def run_peer(impl_dir, name, addr, peer_list, ts_addr, debug, extra_args=()):
     env = os.environ.copy()
     env['TEST_SERVER'] = ts_addr
     cmd = ['python3', os.path.join(impl_dir, 'peer.py'), '-n', name, '-l', addr, '-p', ','.join(peer_list)]
+    cmd.extend(extra_args)
     if debug:
         cmd.append('-d')
         out = None
@@ -52,8 +56,13 @@ class BaseTestCase(unittest.TestCase):
         for i in range(5):
             peer_name = PEER_NAMES[i]
             self.peers.append(peer_name)
-            proc = run_peer(self.impl_dir, peer_name, peer_list[i], peer_list, TEST_SERVER_ADDR, self.debug)
+            proc = run_peer(self.impl_dir, peer_name, peer_list[i], peer_list, TEST_SERVER_ADDR, self.debug,
+                            self.peer_args(peer_name))
             self.peer_processes.append(proc)
+        self.peer_list = peer_list
+
+    def peer_args(self, peer_name):
+        return ()
 
     def tearDown(self):
         for i in range(5):
@@ -313,6 +322,186 @@ class ThreeCrashesRandomTestCase(BaseTestCase):
             "Agreement property is not satisfied: correct - " + str(correct_delivered) + "/2, crashed - " + str(crashed_delivered) + "/3")
 
 
+class RejoinAfterSendTestCase(BaseTestCase):
+    """Пир с файлом состояния перезапускается после своих рассылок: новые сообщения не должны получить старые номера."""
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        super(RejoinAfterSendTestCase, self).setUp()
+
+    def peer_args(self, peer_name):
+        return ['-s', os.path.join(self.state_dir, peer_name + '.json')]
+
+    def tearDown(self):
+        super(RejoinAfterSendTestCase, self).tearDown()
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def expect_delivered(self, bodies):
+        for peer in self.peers[1:]:
+            for body in bodies:
+                msg = self.ts.wait_local_message(peer, 5)
+                self.assertIsNotNone(msg, "Peer not delivered the message")
+                self.assertEqual(msg.body, 'Alice: ' + body)
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(5, 5), "Startup timeout")
+        self.ts.set_real_time_mode(True)
+
+        self.ts.send_local_message(self.peers[0], Message('SEND', 'one'))
+        self.ts.send_local_message(self.peers[0], Message('SEND', 'two'))
+        self.expect_delivered(['one', 'two'])
+        # состояние сохраняется раз в STATE_PERIOD
+        time.sleep(1)
+
+        self.peer_processes[0].kill()
+        self.peer_processes[0].wait()
+        self.peer_processes[0] = run_peer(self.impl_dir, self.peers[0], self.peer_list[0], self.peer_list,
+                                          TEST_SERVER_ADDR, self.debug, self.peer_args(self.peers[0]))
+        self.assertTrue(self.ts.wait_processes(5, 5), "Restart timeout")
+
+        # с прежним номером остальные приняли бы сообщение за повтор и не доставили бы его
+        self.ts.send_local_message(self.peers[0], Message('SEND', 'three'))
+        self.expect_delivered(['three'])
+
+
+class ModeTestCase(BaseTestCase):
+    """Все пиры рассылают сообщения при потерях, Alice падает после своих рассылок.
+    Живые пиры доставляют все сообщения живых отправителей по одному разу и в порядке отправки (FIFO),
+    а сообщения Alice - либо все живые, либо никто (agreement). Режим задают аргументы mode_args."""
+    mode_args = ()
+    drop_rate = 0.2
+    messages = 3
+
+    def peer_args(self, peer_name):
+        return list(self.mode_args)
+
+    def send_all(self):
+        for i in range(self.messages):
+            for peer in self.peers:
+                self.ts.send_local_message(peer, Message('SEND', 'm%d' % i))
+        time.sleep(0.5)
+        self.ts.crash_process(self.peers[0])
+
+    def complete(self, delivered):
+        # все сообщения живых отправителей доставлены, а сообщения Alice у всех одни и те же
+        from_alice = [set(body for body in bodies if body.startswith('Alice: ')) for bodies in delivered.values()]
+        return all(len(bodies) - len(alice) >= self.messages * (len(self.peers) - 1)
+                   for bodies, alice in zip(delivered.values(), from_alice)) and \
+            all(alice == from_alice[0] for alice in from_alice)
+
+    def collect(self, delivered, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline and not self.complete(delivered):
+            for peer in delivered:
+                msg = self.ts.wait_local_message(peer, 0.1)
+                if msg is not None:
+                    self.assertEqual(msg.type, 'DELIVER')
+                    delivered[peer].append(msg.body)
+        # ждём ещё немного: лишняя (повторная) доставка должна успеть проявиться
+        time.sleep(1)
+        for peer in delivered:
+            while True:
+                msg = self.ts.wait_local_message(peer, 0)
+                if msg is None:
+                    break
+                delivered[peer].append(msg.body)
+        return delivered
+
+    def check(self, delivered):
+        for peer, bodies in delivered.items():
+            self.assertEqual(len(bodies), len(set(bodies)), "Peer %s delivered a message twice" % peer)
+            for sender in self.peers:
+                own = [body for body in bodies if body.startswith(sender + ': ')]
+                self.assertListEqual(own, sorted(own), "Peer %s broke FIFO order for %s" % (peer, sender))
+                if sender != self.peers[0]:
+                    self.assertEqual(len(own), self.messages, "Peer %s missed messages from %s" % (peer, sender))
+        from_alice = [set(body for body in bodies if body.startswith('Alice: ')) for bodies in delivered.values()]
+        self.assertTrue(all(alice == from_alice[0] for alice in from_alice), "Agreement property is not satisfied")
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(5, 5), "Startup timeout")
+        self.ts.set_real_time_mode(True)
+        self.ts.set_message_drop_rate(self.drop_rate)
+        self.send_all()
+        delivered = self.collect(self.initial())
+        self.ts.set_message_drop_rate(0)
+        self.check(delivered)
+
+    def initial(self):
+        return {peer: [] for peer in self.peers[1:]}
+
+
+class DropTestCase(ModeTestCase):
+    """Relay с потерями: пропуски в номерах досылаются по NACK."""
+    drop_rate = 0.3
+
+
+class GossipTestCase(ModeTestCase):
+    mode_args = ('-m', 'gossip')
+
+
+class PlumtreeTestCase(ModeTestCase):
+    mode_args = ('-m', 'plumtree')
+
+
+class BatchTestCase(ModeTestCase):
+    mode_args = ('-b', '4')
+    messages = 8
+
+
+class QueueTestCase(ModeTestCase):
+    """Отправка через очереди пиров и поток отправки."""
+    mode_args = ('-q', '2')
+    messages = 8
+
+
+class TotalOrderTestCase(ModeTestCase):
+    """Total order: Alice - первый секвенсер, после её падения номера назначает следующий;
+    все живые пиры доставляют сообщения в одном и том же порядке."""
+    mode_args = ('-o', 'total')
+
+    def check(self, delivered):
+        super(TotalOrderTestCase, self).check(delivered)
+        orders = list(delivered.values())
+        for bodies in orders[1:]:
+            self.assertListEqual(bodies, orders[0], "Peers delivered messages in different order")
+
+
+class CausalOrderTestCase(ModeTestCase):
+    """Causal order: ответ на сообщение нигде не доставляется раньше самого сообщения."""
+    mode_args = ('-o', 'causal')
+
+    def send_all(self):
+        super(CausalOrderTestCase, self).send_all()
+        # Carl отвечает, только когда доставил вопрос Bob'а
+        self.ts.send_local_message(self.peers[1], Message('SEND', 'question'))
+        deadline = time.time() + 10
+        self.carl = []
+        while 'Bob: question' not in self.carl and time.time() < deadline:
+            msg = self.ts.wait_local_message(self.peers[2], 0.1)
+            if msg is not None:
+                self.carl.append(msg.body)
+        self.assertIn('Bob: question', self.carl, "Carl not delivered the question")
+        self.ts.send_local_message(self.peers[2], Message('SEND', 'answer'))
+
+    def initial(self):
+        delivered = super(CausalOrderTestCase, self).initial()
+        delivered[self.peers[2]] = list(self.carl)
+        return delivered
+
+    def complete(self, delivered):
+        return all('Carl: answer' in bodies for bodies in delivered.values()) and \
+            super(CausalOrderTestCase, self).complete(delivered)
+
+    def check(self, delivered):
+        for peer, bodies in delivered.items():
+            self.assertIn('Carl: answer', bodies, "Peer %s not delivered the answer" % peer)
+            self.assertLess(bodies.index('Bob: question'), bodies.index('Carl: answer'),
+                            "Peer %s delivered the answer before the question" % peer)
+            delivered[peer] = [body for body in bodies if body not in ('Bob: question', 'Carl: answer')]
+        super(CausalOrderTestCase, self).check(delivered)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(dest='impl_dir', metavar='DIRECTORY',
@@ -336,6 +525,22 @@ def main():
             args.impl_dir, args.debug),
         TwoCrashesRandomTestCase(
             args.impl_dir, args.debug),
+        RejoinAfterSendTestCase(
+            args.impl_dir, args.debug),
+        DropTestCase(
+            args.impl_dir, args.debug),
+        GossipTestCase(
+            args.impl_dir, args.debug),
+        PlumtreeTestCase(
+            args.impl_dir, args.debug),
+        BatchTestCase(
+            args.impl_dir, args.debug),
+        QueueTestCase(
+            args.impl_dir, args.debug),
+        TotalOrderTestCase(
+            args.impl_dir, args.debug),
+        CausalOrderTestCase(
+            args.impl_dir, args.debug),
         # uncomment to see what happens when 3 of 5 processes fail
         # ThreeCrashesRandomTestCase(
         #     args.impl_dir, args.debug),
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from dslib.message import Message
+from dslib.test_server import TestServer
+
+from test import SERVER_ADDR, TEST_SERVER_ADDR, run_receiver, run_sender
+
+
+TYPES = ['INFO-1', 'INFO-2', 'INFO-3', 'INFO-4']
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def sender_args(args, mode):
+    if mode == 'stop':
+        return []
+    extra_args = ['-w', str(args.window)]
+    if args.target is not None:
+        extra_args.extend(['-p', str(args.target)])
+    return extra_args
+
+
+def collect_stats(ts, process, timeout):
+    # ответ на STATS приходит в ту же локальную очередь, что и доставленные сообщения - остальное пропускаем
+    ts.send_local_message(process, Message('STATS'))
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        msg = ts.wait_local_message(process, max(0, deadline - time.time()))
+        if msg is not None and msg.type == 'STATS':
+            return msg.body
+    return {}
+
+
+def run_bench(args, mode, msg_type, drop, dup):
+    ts = TestServer(TEST_SERVER_ADDR)
+    ts.start()
+    receiver = run_receiver(args.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, args.debug)
+    sender = run_sender(args.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, args.debug, sender_args(args, mode))
+    try:
+        if not ts.wait_processes(2, args.startup):
+            logging.error("Startup timeout")
+            return None
+        ts.set_real_time_mode(True)
+        ts.set_message_drop_rate(drop)
+        ts.set_repeat_rate(dup, args.dup_count)
+        ts.set_event_reordering(args.reorder)
+
+        sent_at = dict()
+        for i in range(args.messages):
+            body = 'msg%d' % i
+            sent_at[body] = time.time()
+            ts.send_local_message('sender', Message(msg_type, body))
+            time.sleep(args.gap)
+
+        # ждём, пока доставят всё; INFO-1 может терять сообщения, поэтому останавливаемся и после паузы без доставок
+        delivered = dict()                              # тело -> время первой доставки
+        bodies = list()                                 # все доставки по порядку, с повторами
+        deadline = time.time() + args.wait
+        idle_until = time.time() + args.idle
+        while len(delivered) < args.messages and time.time() < min(deadline, idle_until):
+            msg = ts.wait_local_message('receiver', 0.1)
+            if msg is None or msg.type != msg_type:
+                continue
+            bodies.append(msg.body)
+            delivered.setdefault(msg.body, time.time())
+            idle_until = time.time() + args.idle
+
+        sender_stats = collect_stats(ts, 'sender', 1)
+        receiver_stats = collect_stats(ts, 'receiver', 1)
+        return summarize(mode, msg_type, drop, dup, sent_at, delivered, bodies, sender_stats, receiver_stats)
+    finally:
+        sender.terminate()
+        receiver.terminate()
+        ts.stop()
+        sender.kill()
+        receiver.kill()
+
+
+def summarize(mode, msg_type, drop, dup, sent_at, delivered, bodies, sender_stats, receiver_stats):
+    traffic = [stats.get('traffic', {}) for stats in (sender_stats, receiver_stats)]
+    messages = sum(sum(t.get('sent', {}).values()) for t in traffic)
+    size = sum(t.get('bytes', 0) for t in traffic)
+    count = max(1, len(delivered))
+    latencies = [delivered[body] - sent_at[body] for body in delivered if body in sent_at]
+    elapsed = max(delivered.values()) - min(sent_at.values()) if delivered else 0
+    return {
+        'mode': mode,
+        'type': msg_type,
+        'drop': drop,
+        'dup': dup,
+        'sent': len(sent_at),
+        'delivered': len(delivered),
+        'duplicates': len(bodies) - len(delivered),
+        'in order': bodies == sorted(bodies, key=lambda body: sent_at.get(body, 0)),
+        'msgs/delivered': messages / count,
+        'bytes/delivered': size / count,
+        'msgs/s': len(delivered) / elapsed if elapsed > 0 else 0.0,
+        'p50 ms': percentile(latencies, 50) * 1000,
+        'p90 ms': percentile(latencies, 90) * 1000,
+        'p99 ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='impl_dir', metavar='DIRECTORY',
+                        help="directory with implementation to benchmark")
+    parser.add_argument('-t', dest='types', default=','.join(TYPES), help="comma-separated message types")
+    parser.add_argument('-m', dest='modes', default='stop,window',
+                        help="comma-separated sender modes: stop (stop-and-wait) and window")
+    parser.add_argument('-w', dest='window', type=int, default=32, help="window size for window mode")
+    parser.add_argument('-p', dest='target', type=float, default=None,
+                        help="delivery probability per round for redundant copies in window mode")
+    parser.add_argument('-c', dest='messages', type=int, default=100, help="number of messages per run")
+    parser.add_argument('--drop', default='0,0.1,0.3', help="comma-separated message drop rates")
+    parser.add_argument('--dup', default='0,0.3', help="comma-separated message repeat rates")
+    parser.add_argument('--dup-count', type=int, default=1, help="max extra copies of a repeated message")
+    parser.add_argument('--reorder', action='store_true', help="enable event reordering")
+    parser.add_argument('--gap', type=float, default=0, help="pause between messages (seconds)")
+    parser.add_argument('--wait', type=float, default=60, help="how long to wait for delivery (seconds)")
+    parser.add_argument('--idle', type=float, default=3, help="stop waiting after so long without deliveries")
+    parser.add_argument('--startup', type=float, default=5, help="how long to wait for processes to start")
+    parser.add_argument('-o', dest='output', default='bench.json', help="file to write JSON results to")
+    parser.add_argument('-d', dest='debug', action='store_true',
+                        help="include debugging output from implementation")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+    results = []
+    for mode in args.modes.split(','):
+        for msg_type in args.types.split(','):
+            for drop in map(float, args.drop.split(',')):
+                for dup in map(float, args.dup.split(',')):
+                    result = run_bench(args, mode, msg_type, drop, dup)
+                    if result is not None:
+                        results.append(result)
+                        logging.info("%s", result)
+
+    if not results:
+        return 1
+    # порядок прогонов и ключей постоянный, чтобы результаты двух версий можно было сравнить diff'ом
+    with open(args.output, 'w') as f:
+        json.dump({'args': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+        f.write('\n')
+    columns = list(results[0])
+    print(' | '.join('%15s' % column for column in columns))
+    for result in results:
+        print(' | '.join('%15.2f' % value if isinstance(value, float) else '%15s' % value
+                         for value in result.values()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,70 +3,315 @@
 import argparse
 import logging
 import collections
+import json
+import mmap
+import os
+import struct
+import time
 
 from dslib import Communicator, Message
 
 
+DEDUP_BITS = 4096           # сколько номеров выше watermark помним (окно sender'а не должно быть больше)
+ACK_DELAY = 0.02            # сколько секунд копим подтверждения перед отправкой одного ACK
+ACK_EVERY = 8               # или отправляем ACK сразу, если накопилось столько новых сообщений
+RECV_WINDOW = 1024          # сколько номеров после накопительного ACK разрешаем sender'у отправить
+MAX_SACK = 16               # сколько диапазонов полученных номеров выше watermark кладём в ACK
+LOG_RECORD = struct.Struct('<BQI')  # запись журнала: индекс типа, watermark, длина битовой маски в байтах
+COMPACT_BYTES = 1 << 20     # когда журнал больше, переписываем его с одной записью на тип
+TYPES = ['INFO-1', 'INFO-2', 'INFO-3', 'INFO-4']
+
+
+class SeqFilter:
+    # полученные номера одного типа: все номера <= watermark уже были, выше - битовая маска
+    def __init__(self):
+        self.watermark = 0
+        self.bits = 0                                       # бит i - получен номер watermark + 1 + i
+
+    def add(self, seq):
+        # True, если номер пришёл впервые
+        offset = seq - self.watermark - 1
+        if offset < 0 or (self.bits >> offset) & 1:
+            return False
+        if offset >= DEDUP_BITS:
+            # номер слишком далеко впереди - забываем самые старые пропуски
+            shift = offset - DEDUP_BITS + 1
+            self.bits >>= shift
+            self.watermark += shift
+            offset -= shift
+        self.bits |= 1 << offset
+        # сдвигаем watermark через непрерывный префикс полученных номеров
+        ones = (~self.bits & (self.bits + 1)).bit_length() - 1
+        self.bits >>= ones
+        self.watermark += ones
+        return True
+
+    def advance(self, watermark):
+        # все номера <= watermark уже обработаны (так говорит sender) - пропуски до него больше не ждём
+        if watermark <= self.watermark:
+            return
+        self.bits >>= watermark - self.watermark
+        self.watermark = watermark
+        ones = (~self.bits & (self.bits + 1)).bit_length() - 1
+        self.bits >>= ones
+        self.watermark += ones
+
+    def gap_before(self, seq):
+        # seq - самый большой полученный номер, а предыдущий ещё не пришёл: перед ним новая дыра
+        offset = seq - self.watermark - 1
+        return offset > 0 and self.bits.bit_length() == offset + 1 and not (self.bits >> (offset - 1)) & 1
+
+    def ranges(self, limit):
+        # непрерывные диапазоны полученных номеров выше watermark: [[первый, последний], ...]
+        result = []
+        bits = self.bits
+        base = self.watermark + 1
+        while bits and len(result) < limit:
+            zeros = (bits & -bits).bit_length() - 1
+            bits >>= zeros
+            base += zeros
+            ones = (~bits & (bits + 1)).bit_length() - 1
+            result.append([base, base + ones - 1])
+            bits >>= ones
+            base += ones
+        return result
+
+
+class DedupLog:
+    # журнал состояния SeqFilter'ов: только дописываем записи, последняя запись для типа - актуальная
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'ab')
+
+    def load(self):
+        states = dict()
+        if os.path.getsize(self._path) == 0:
+            return states
+        with open(self._path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            pos = 0
+            while pos + LOG_RECORD.size <= len(data):
+                type_index, watermark, length = LOG_RECORD.unpack_from(data, pos)
+                end = pos + LOG_RECORD.size + length
+                if end > len(data):
+                    break                                   # запись, недописанная при падении
+                states[TYPES[type_index]] = (watermark, int.from_bytes(data[pos + LOG_RECORD.size:end], 'little'))
+                pos = end
+        return states
+
+    @staticmethod
+    def encode(msg_type, seqs):
+        bits = seqs.bits.to_bytes((seqs.bits.bit_length() + 7) // 8, 'little')
+        return LOG_RECORD.pack(TYPES.index(msg_type), seqs.watermark, len(bits)) + bits
+
+    def commit(self, filters, types):
+        # одна запись и один fsync на всю пачку изменений (group commit)
+        for msg_type in types:
+            self._file.write(self.encode(msg_type, filters[msg_type]))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._file.tell() > COMPACT_BYTES:
+            self.compact(filters)
+
+    def compact(self, filters):
+        with open(self._path + '.tmp', 'wb') as f:
+            for msg_type, seqs in filters.items():
+                f.write(self.encode(msg_type, seqs))
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(self._path + '.tmp', self._path)
+        self._file = open(self._path, 'ab')
+
+
 class Receiver:
-    def __init__(self, name, addr):
+    def __init__(self, name, addr, log_path=None, window=RECV_WINDOW):
         self._comm = Communicator(name, addr)
-        self._received_msgs = set()                         # множество уже полученных сообщений
+        self._window = min(window, DEDUP_BITS)              # дальше watermark фильтр номера не помнит
+        self._received_msgs = set()                         # множество уже полученных сообщений (без seq)
+        self._filters = collections.defaultdict(SeqFilter)  # тип -> полученные номера сообщений с seq
+        self._unacked = dict()                              # тип -> сколько новых сообщений ещё не подтвердили
+        self._ack_to = dict()                               # тип -> адрес sender'а
+        self._ack_deadline = None                           # когда отправить накопленные ACK
+        self._reorder = dict()                              # INFO-4: seq -> сообщение, пришедшее раньше предыдущих
+        self._next_deliver = 1                              # INFO-4: следующий номер, который отдадим пользователю
+        self._log = None                                    # журнал номеров, чтобы пережить перезапуск
+        self._dirty = set()                                 # типы, чьи номера изменились после записи в журнал
+        self._pending = list()                              # сообщения, которые отдадим пользователю после записи
+        self._sent = collections.Counter()                  # тип -> сколько сообщений отправили по сети
+        self._bytes = 0                                     # сколько байт в них (тело и заголовки в JSON)
+        if log_path is not None:
+            self._log = DedupLog(log_path)
+            for msg_type, (watermark, bits) in self._log.load().items():
+                self._filters[msg_type].watermark = watermark
+                # буфер INFO-4 не сохраняется: недоставленные сообщения sender пришлёт снова
+                self._filters[msg_type].bits = 0 if msg_type == 'INFO-4' else bits
+            self._next_deliver = self._filters['INFO-4'].watermark + 1
+
+    def is_new(self, msg):
+        # у сообщений, отправленных окном, есть номер: повторы отличаем по нему за O(1) и O(окна) памяти
+        seq = (msg.headers or {}).get('seq')
+        if seq is not None:
+            # receiver перезапустили без журнала: номера до base подтвердил и отдал пользователю прежний процесс
+            base = msg.headers.get('base')
+            if base is not None and base - 1 > self._filters[msg.type].watermark:
+                self._filters[msg.type].advance(base - 1)
+                if msg.type == 'INFO-4':
+                    self._reorder = dict((s, m) for s, m in self._reorder.items() if s >= base)
+                    self._next_deliver = max(self._next_deliver, base)
+            if not self._filters[msg.type].add(seq):
+                return False
+            if self._log is not None:
+                self._dirty.add(msg.type)
+                if self._ack_deadline is None:
+                    self._ack_deadline = time.time() + ACK_DELAY
+            return True
+        if msg in self._received_msgs:
+            return False
+        self._received_msgs.add(msg)
+        return True
+
+    def reply(self, msg, new):
+        # stop-and-wait: отвечаем тем же сообщением; режим окна: копим подтверждения и отправляем одним ACK
+        if (msg.headers or {}).get('seq') is None:
+            self.send(msg, msg._sender)
+            return
+        self._ack_to[msg.type] = msg._sender
+        self._unacked[msg.type] = self._unacked.get(msg.type, 0) + new
+        if msg.headers.get('retry') or self._unacked[msg.type] >= ACK_EVERY or \
+                (new and self._filters[msg.type].gap_before(msg.headers['seq'])):
+            # повтор значит, что sender не дождался ACK, а номер через пропуск - что перед ним новая дыра:
+            # в обоих случаях отвечаем сразу (лишние копии одного раунда и дубли сети подтверждаем по таймеру)
+            self.send_ack(msg.type)
+        elif self._ack_deadline is None:
+            self._ack_deadline = time.time() + ACK_DELAY
+
+    def deliver(self, msg):
+        # с журналом сначала записываем номер, потом отдаём пользователю: после перезапуска повтора не будет;
+        # у сообщений stop-and-wait номера нет - записывать нечего, отдаём сразу
+        if self._log is None or (msg.headers or {}).get('seq') is None:
+            self._comm.send_local(msg)
+        else:
+            self._pending.append(msg)
+
+    def commit(self):
+        if self._log is not None and self._dirty:
+            self._log.commit(self._filters, self._dirty)
+            self._dirty.clear()
+        for msg in self._pending:
+            self._comm.send_local(msg)
+        self._pending.clear()
+
+    def send(self, msg, addr):
+        self._sent[msg.type] += 1
+        self._bytes += len(json.dumps([msg.type, msg.body, msg.headers]))
+        self._comm.send(msg, addr)
+
+    def send_ack(self, msg_type):
+        # подтверждаем только то, что уже записано в журнал
+        self.commit()
+        seqs = self._filters[msg_type]
+        # окно - свободное место за watermark: сообщения, ещё не отданные пользователю, его занимают
+        # (и ждущие записи в журнал, и буфер перестановок INFO-4)
+        held = sum(1 for msg in self._pending if msg.type == msg_type)
+        if msg_type == 'INFO-4':
+            held += len(self._reorder)
+        window = max(0, self._window - held)
+        ack = Message('ACK', [msg_type, seqs.watermark, seqs.ranges(MAX_SACK), window])
+        self.send(ack, self._ack_to[msg_type])
+        self._unacked[msg_type] = 0
+
+    def flush_acks(self):
+        self.commit()
+        for msg_type, count in self._unacked.items():
+            if count:
+                self.send_ack(msg_type)
+        self._ack_deadline = None
 
     def run(self):
         while True:
-            msg = self._comm.recv()
+            timeout = None if self._ack_deadline is None else max(0, self._ack_deadline - time.time())
+            msg = self._comm.recv(timeout=timeout)
+            if self._ack_deadline is not None and time.time() >= self._ack_deadline:
+                self.flush_acks()
+            if msg is None:
+                continue
 
             # deliver INFO-1 message to receiver user
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all that were recieved but at most once
             if msg.type == 'INFO-1':
-                if msg not in self._received_msgs:
-                    self._comm.send_local(msg)
-                    self._received_msgs.add(msg)                    # добавляем полученное сообщение
-                                                                    # в множество уже полученных сообщений
-                                                                    # чтобы не отправить одно сообщение дважды
+                if self.is_new(msg):                                # запоминаем полученное сообщение,
+                    self.deliver(msg)                               # чтобы не отправить одно сообщение дважды
 
             # deliver INFO-2 message to receiver user
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all at least once
             elif msg.type == 'INFO-2':
                 self._comm.send_local(msg)                           # а здесь можем отправлять сообщения сколь угодно
-                self._comm.send(msg, msg._sender)
+                seq = (msg.headers or {}).get('seq')                 # номер запоминаем только для ACK
+                self.reply(msg, seq is not None and self.is_new(msg))
 
             # deliver INFO-3 message to receiver user
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all exactly once
             elif msg.type == 'INFO-3':
-                if msg not in self._received_msgs:
-                    self._comm.send_local(msg)
-                    self._received_msgs.add(msg)
-                self._comm.send(msg, msg._sender)                      # здесь нам важно отправить ответ sender'у
+                new = self.is_new(msg)
+                if new:
+                    self.deliver(msg)
+                self.reply(msg, new)                                   # здесь нам важно отправить ответ sender'у
 
             # deliver INFO-4 message to receiver user
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all exactly once in the order
             elif msg.type == 'INFO-4':
-                if msg not in self._received_msgs:
-                    self._comm.send_local(msg)
-                    self._received_msgs.add(msg)
-                self._comm.send(msg, msg._sender)                      # здесь нам важно отправить ответ sender'у
+                new = self.is_new(msg)
+                seq = (msg.headers or {}).get('seq')
+                if new and seq is None:
+                    self.deliver(msg)
+                elif new:
+                    # watermark фильтра - это непрерывный префикс пришедших номеров, его и можно отдать по порядку
+                    self._reorder[seq] = msg
+                    # номеров, которых нет в буфере, фильтр уже не ждёт (ушли дальше DEDUP_BITS) - их пропускаем
+                    watermark = self._filters[msg.type].watermark
+                    if watermark - self._next_deliver >= len(self._reorder):
+                        ready = sorted(s for s in self._reorder if s <= watermark)
+                    else:
+                        ready = [s for s in range(self._next_deliver, watermark + 1) if s in self._reorder]
+                    for s in ready:
+                        self.deliver(self._reorder.pop(s))
+                    self._next_deliver = max(self._next_deliver, watermark + 1)
+                self.reply(msg, new)                                   # здесь нам важно отправить ответ sender'у
+
+            # сколько сообщений и байт receiver отправил по сети (для bench.py)
+            elif msg.type == 'STATS' and msg.is_local():
+                self._comm.send_local(Message('STATS', {'traffic': {'sent': dict(self._sent), 'bytes': self._bytes}}))
+
+            # sender ждёт открытия окна - отвечаем текущим ACK
+            elif msg.type == 'PROBE':
+                self._ack_to[msg.body[0]] = msg._sender
+                self.send_ack(msg.body[0])
 
             # unknown message
             else:
                 err = Message('ERROR', 'unknown message type: %s' % msg.type)
-                self._comm.send(err, msg.sender)
+                self.send(err, msg.sender)
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', dest='addr', metavar='host:port',
                         help='listen on specified address', default='127.0.0.1:9701')
+    parser.add_argument('-s', dest='log_path', metavar='path',
+                        help='file to keep delivered sequence numbers across restarts', default=None)
+    parser.add_argument('-b', dest='window', metavar='count', type=int,
+                        help='how many messages ahead of the last acknowledged one the sender may send',
+                        default=RECV_WINDOW)
     parser.add_argument('-d', dest='log_level', action='store_const', const=logging.DEBUG,
                         help='print debugging info', default=logging.WARNING)
     args = parser.parse_args()
     logging.basicConfig(format="%(asctime)s - %(message)s", level=args.log_level)
     args = parser.parse_args()
 
-    receiver = Receiver('receiver', args.addr)
+    receiver = Receiver('receiver', args.addr, args.log_path, args.window)
     receiver.run()
 
 
@@ -3,17 +3,320 @@
 import argparse
 import logging
 import collections
+import json
+import math
+import queue
+import threading
+import time
 
 from dslib import Communicator, Message
 
 
+RETRY_TIMEOUT = 0.5         # начальный таймаут повтора, пока нет замеров RTT (секунды)
+MIN_RTO = 0.05              # нижняя граница таймаута повтора
+MAX_RTO = 2.0               # верхняя граница таймаута повтора в режиме окна
+MAX_BACKOFF = 64            # во сколько раз максимум увеличиваем таймаут при повторных потерях
+INTAKE_SIZE = 1024          # сколько принятых локальных сообщений может ждать своего канала (остальные отклоняем)
+LOSS_ALPHA = 0.02           # вес нового раунда в сглаженной доле неудачных раундов
+MAX_COPIES = 4              # больше копий одного сообщения за раунд не отправляем
+MAX_TARGET = 0.999999       # вероятность доставки 1 недостижима (log(0)), выше этой не просим
+MAX_WINDOW = 4096           # receiver помнит столько номеров выше watermark (DEDUP_BITS), окно не может быть больше
+INITIAL_CWND = 4            # сколько сообщений канал отправляет до первых ACK'ов (окно перегрузки)
+CONGESTION_LOSS = 2         # потери за окно во столько раз выше обычных - это перегрузка, а не шум сети
+
+
+class RtoEstimator:
+    # таймаут повтора по замерам RTT: сглаженный RTT и его разброс (как в TCP), экспоненциальный backoff при потерях
+    def __init__(self, ceiling=MAX_RTO):
+        self._ceiling = ceiling
+        self._srtt = None
+        self._rttvar = None
+        self._backoff = 1
+        self._samples = 0
+        self._timeouts = 0
+        self._backoff_until = 0             # пока не прошёл текущий таймаут, новые потери backoff не увеличивают
+
+    def sample(self, rtt):
+        # по правилу Карна сюда попадают только сообщения, отправленные один раз
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        self._backoff = 1
+        self._samples += 1
+
+    def timeout(self):
+        # в окне таймеры истекают у многих сообщений подряд - это одна потеря пачки, а не много раз по одной
+        now = time.time()
+        if now >= self._backoff_until:
+            self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+            self._backoff_until = now + self.value()
+        self._timeouts += 1
+
+    def rtt_bound(self):
+        # дольше этого ответ почти наверняка не идёт: сглаженный RTT плюс четыре разброса, без границ и backoff
+        return RETRY_TIMEOUT if self._srtt is None else self._srtt + 4 * self._rttvar
+
+    def backoff(self):
+        # во сколько раз таймаут сейчас увеличен: больше 2 - подряд истекают и повторы
+        return self._backoff
+
+    def value(self):
+        rto = RETRY_TIMEOUT if self._srtt is None else self._srtt + 4 * self._rttvar
+        return min(self._ceiling, max(MIN_RTO, rto * self._backoff))
+
+    def stats(self):
+        return {'srtt': self._srtt, 'rttvar': self._rttvar, 'rto': self.value(), 'backoff': self._backoff,
+                'samples': self._samples, 'timeouts': self._timeouts}
+
+
+class LossEstimator:
+    # доля потерь по ACK'ам: раунд (отправка copies копий) неудачен, если ACK показывает дыру на его месте -
+    # более поздние номера receiver получил, а этот нет, хотя с отправки прошло больше, чем обычно идёт ответ
+    # (так не путаем потерю с перестановкой), или если раунд не подтвердили до таймаута.
+    # Если раунд теряется с вероятностью q, то одна копия - с вероятностью q^(1/copies)
+    def __init__(self, target=None):
+        # нужная вероятность доставки за раунд, None - всегда одна копия
+        self._target = None if target is None else min(max(target, 0.0), MAX_TARGET)
+        self._failure = 0.0
+        self.copies = 1
+
+    def round(self, failed):
+        self._failure = (1 - LOSS_ALPHA) * self._failure + LOSS_ALPHA * failed
+        if self._target is not None:
+            copies = self.choose()
+            # пересчитываем долю неудачных раундов на новое число копий, чтобы дальше сглаживать однородные замеры
+            self._failure = self.loss() ** copies
+            self.copies = copies
+
+    def loss(self):
+        return self._failure ** (1 / self.copies)
+
+    def choose(self):
+        # наименьшее k, при котором 1 - loss^k >= target
+        loss = self.loss()
+        if loss <= 0:
+            return 1
+        if loss >= 1:
+            return MAX_COPIES
+        return max(1, min(MAX_COPIES, math.ceil(math.log(1 - self._target) / math.log(loss))))
+
+
+class Channel(threading.Thread):
+    # окно неподтверждённых сообщений одного типа: в полёте одновременно до window сообщений,
+    # у каждого свой номер (заголовок seq) и свой таймер повторной отправки.
+    # Каждый канал работает в своём потоке, поэтому потери в одном типе не задерживают другие
+    def __init__(self, send, recv_addr, msg_type, window, target=None, hold_sacked=False):
+        super(Channel, self).__init__(daemon=True)
+        self._send = send
+        self._rto = RtoEstimator()
+        self._loss = LossEstimator(target)
+        self._sent = 0                                      # сколько всего копий отправили (цена избыточности)
+        self._recv_addr = recv_addr
+        self._type = msg_type
+        self._window = window
+        self._seq_no = 0
+        self._intake = queue.Queue(maxsize=INTAKE_SIZE)     # принятые локальные сообщения, ждущие места в окне
+        self._events = queue.Queue()                        # ACK'и и сигналы о новых сообщениях в _intake
+        self._in_flight = collections.OrderedDict()     # seq -> [сообщение, время повторной отправки,
+                                                        #        время отправки, был ли повтор,
+                                                        #        засчитана ли потеря этого раунда, есть ли в SACK]
+        # SACK только совет: receiver держит такие сообщения в буфере и может их потерять при перезапуске,
+        # поэтому из окна их убирает только накопительный ACK (нужно для INFO-4)
+        self._hold_sacked = hold_sacked
+        self._cwnd = min(INITIAL_CWND, window)              # окно перегрузки (AIMD), не больше window
+        self._ssthresh = window                             # до этого окна растём быстро (slow start)
+        self._round_end = 0                                 # окно перегрузки оцениваем раз за окно сообщений:
+        self._round_sent = 0                                #   когда подтвердят этот номер, сравниваем
+        self._round_lost = 0                                #   долю потерь за окно с обычной долей потерь
+        self._cumulative = 0                                # последний накопительный ACK
+        self._right_edge = window                           # receiver разрешил номера до этого включительно
+        self._probe_at = None                               # когда спросить receiver'а о закрытом окне
+
+    def submit(self, msg):
+        # вызывается из потока приёма; False - очередь канала заполнена, сообщение надо предложить позже
+        try:
+            self._intake.put_nowait(msg)
+        except queue.Full:
+            return False
+        self._events.put(None)
+        return True
+
+    def ack(self, cumulative, sack, receive_window):
+        self._events.put((cumulative, sack, receive_window))
+
+    def stats(self):
+        stats = self._rto.stats()
+        stats.update({'loss': self._loss.loss(), 'copies': self._loss.copies, 'sent': self._sent,
+                      'cwnd': self._cwnd, 'ssthresh': self._ssthresh, 'rwnd': self._right_edge - self._cumulative})
+        return stats
+
+    def transmit(self, msg):
+        # на сети с потерями сразу отправляем несколько копий, чтобы не ждать таймаута
+        for _ in range(self._loss.copies):
+            self._send(msg)
+        self._sent += self._loss.copies
+
+    def run(self):
+        while True:
+            deadline = self.next_deadline()
+            try:
+                event = self._events.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except queue.Empty:
+                event = None
+            if event is not None:
+                self.on_ack(*event)
+            self.fill()
+            self.on_timer(time.time())
+
+    def pipe(self):
+        # сколько сообщений ещё в сети (без тех, что receiver уже держит в буфере)
+        return sum(1 for entry in self._in_flight.values() if not entry[5])
+
+    def window_closed(self):
+        return self._seq_no + 1 > self._right_edge
+
+    def fill(self):
+        pipe = self.pipe()
+        while pipe < min(self._cwnd, self._window) and not self.window_closed():
+            try:
+                msg = self._intake.get_nowait()
+            except queue.Empty:
+                return
+            pipe += 1
+            self._round_sent += 1
+            self._seq_no += 1
+            headers = dict(msg.headers or {})
+            headers['seq'] = self._seq_no
+            headers['base'] = self._cumulative + 1      # всё до base receiver уже подтвердил (нужно после его перезапуска)
+            out = Message(msg.type, msg.body, headers)
+            now = time.time()
+            self._in_flight[self._seq_no] = [out, now + self._rto.value(), now, False, False, False]
+            self.transmit(out)
+
+    def on_ack(self, cumulative, sack, receive_window):
+        # один ACK освобождает все номера до cumulative и все диапазоны из sack,
+        # а receiver разрешает отправлять номера до cumulative + receive_window
+        if cumulative >= self._cumulative:
+            self._cumulative = cumulative
+            self._right_edge = cumulative + receive_window
+            if not self.window_closed():
+                self._probe_at = None
+        if cumulative >= self._round_end:
+            self.end_round()
+        acked = list()                                  # подтверждённые этим ACK'ом впервые
+        while self._in_flight and next(iter(self._in_flight)) <= cumulative:
+            entry = self._in_flight.popitem(last=False)[1]
+            if not entry[5]:
+                acked.append(entry)
+        sacked = set()
+        for first, last in sack:
+            for seq in range(max(first, cumulative + 1), last + 1):
+                if seq not in self._in_flight:
+                    continue
+                sacked.add(seq)
+                if not self._hold_sacked:
+                    acked.append(self._in_flight.pop(seq))
+                elif not self._in_flight[seq][5]:
+                    self._in_flight[seq][5] = True
+                    acked.append(self._in_flight[seq])
+        # RTT меряем по последнему отправленному из подтверждённых, если его не повторяли
+        now = time.time()
+        for entry in acked:
+            if not entry[4]:
+                self._loss.round(False)
+            # окно перегрузки: +1 за ACK в slow start, потом +1 за окно
+            self._cwnd = min(self._window, self._cwnd + (1 if self._cwnd < self._ssthresh else 1 / self._cwnd))
+        highest = max([cumulative] + [last for first, last in sack])
+        for seq, entry in self._in_flight.items():
+            if seq > highest:
+                break
+            if entry[5] and seq not in sacked:
+                # receiver перезапустился и потерял буфер - снова ждём ACK и повторяем по таймеру
+                entry[5] = False
+                entry[1] = now + self._rto.value()
+            if not entry[5] and not entry[4] and now - entry[2] > self._rto.rtt_bound():
+                # дыра держится дольше обычного ответа - сообщение потеряно, повторяем сразу, не дожидаясь таймаута
+                self._loss.round(True)
+                self._round_lost += 1
+                self.retransmit(entry, now)
+                entry[4] = True
+        fresh = [entry for entry in acked if not entry[3]]
+        if fresh:
+            self._rto.sample(now - max(entry[2] for entry in fresh))
+
+    def on_timer(self, now):
+        expired = [entry for entry in self._in_flight.values() if entry[1] <= now and not entry[5]]
+        if expired:
+            self._rto.timeout()
+            if self._rto.backoff() > 2:
+                # повторы тоже не доходят - сеть перегружена или недоступна: начинаем заново с одного сообщения
+                self._ssthresh = max(self._cwnd / 2, 1)
+                self._cwnd = 1
+        self._round_lost += len(expired)
+        for entry in expired:
+            if not entry[4]:
+                # раунд не подтвердили до таймаута - это тоже потеря (иначе без более поздних номеров,
+                # на редком или последнем сообщении, оценка потерь остаётся около нуля)
+                self._loss.round(True)
+            self.retransmit(entry, now)
+        # receiver закрыл окно, а ACK'ов больше не будет - время от времени спрашиваем, не открылось ли оно
+        if self.window_closed() and not self._intake.empty() and self.pipe() == 0:
+            if self._probe_at is None:
+                self._probe_at = now + self._rto.value()
+            elif self._probe_at <= now:
+                self._send(Message('PROBE', [self._type]))
+                self._probe_at = now + self._rto.value()
+
+    def end_round(self):
+        # AIMD: окно уменьшаем вдвое, только если за окно потерь заметно больше обычного -
+        # случайные потери сети (их доля уже в LossEstimator) перегрузкой не считаем, иначе окно не вырастет
+        if self._round_lost and self._round_lost > CONGESTION_LOSS * self._loss.loss() * max(1, self._round_sent):
+            self._ssthresh = max(self._cwnd / 2, 1)
+            self._cwnd = self._ssthresh
+        self._round_end = self._seq_no
+        self._round_sent = 0
+        self._round_lost = 0
+
+    def retransmit(self, entry, now):
+        entry[0].headers['retry'] = True                # receiver отвечает на повтор сразу, а не по таймеру
+        entry[0].headers['base'] = self._cumulative + 1
+        self.transmit(entry[0])
+        entry[1] = now + self._rto.value()
+        entry[2] = now
+        entry[3] = True
+        entry[4] = False
+
+    def next_deadline(self):
+        deadlines = [entry[1] for entry in self._in_flight.values() if not entry[5]]
+        if self._probe_at is not None:
+            deadlines.append(self._probe_at)
+        elif self.window_closed() and not self._intake.empty():
+            deadlines.append(time.time() + self._rto.value())
+        return min(deadlines, default=None)
+
+
 class Sender:
-    def __init__(self, name, recv_addr):
+    def __init__(self, name, recv_addr, window=0, target=None):
         self._comm = Communicator(name)
         self._recv_addr = recv_addr
         self._local_messages = collections.deque()                  # очередь локальных сообщений
+        self._window = window                                       # 0 - stop-and-wait, иначе размер окна
+        self._target = target                                       # вероятность доставки за раунд для копий
+        self._channels = dict()                                     # тип сообщения -> Channel
+        self._send_lock = threading.Lock()                          # send вызывают потоки всех каналов
+        self._info1_seq = 0                                         # номер последнего INFO-1 в режиме окна
+        self._sent = collections.Counter()                          # тип -> сколько сообщений отправили по сети
+        self._bytes = 0                                             # сколько байт в них (тело и заголовки в JSON)
+        # в stop-and-wait таймаут не больше прежних RETRY_TIMEOUT: тесты в пошаговом режиме ждут повтор не дольше
+        self._rto = RtoEstimator(RETRY_TIMEOUT)
 
     def run(self):
+        if self._window > 0:
+            self.run_window()
+            return
         while True:
             try:                                                    # берём очередное локальное сообщение
                 msg = self._local_messages.popleft()
@@ -24,56 +327,100 @@ class Sender:
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all that were recieved but at most once
             if msg.type == 'INFO-1':
-                self._comm.send(msg, self._recv_addr)                       # просто отправляем
+                self.send(msg)                                              # просто отправляем
 
             # deliver INFO-2 message to receiver user
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all at least once
             elif msg.type == 'INFO-2':
-                while True:                                                 # отправляем и ждём ответ;
-                    self._comm.send(msg, self._recv_addr)                   # если ответ - сообщение с локального сервера,
-                    resp = self._comm.recv(timeout=0.5)                     # то добавляем его в очередь и дальше ждём ответ
-                    if resp is None:                                        # от receiver'а (с повторной отправкой)
-                        continue
-                    elif resp.is_local():
-                        self._local_messages.append(resp)
-                    else:
-                        resp._sender = msg._sender
-                        if resp == msg:
-                            break
+                self.send_and_wait(msg)
 
             # deliver INFO-3 message to receiver user
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all exactly once
             elif msg.type == 'INFO-3':
-                while True:                                                 # для INFO-3 логика такая же, как для INFO-2,
-                    self._comm.send(msg, self._recv_addr)                   # отличия есть только у receiver'a
-                    resp = self._comm.recv(timeout=0.5)
-                    if resp is None:
-                        continue
-                    elif resp.is_local():
-                        self._local_messages.append(resp)
-                    else:
-                        resp._sender = msg._sender
-                        if resp == msg:
-                            break
+                self.send_and_wait(msg)                                     # для INFO-3 логика такая же, как для INFO-2,
+                                                                            # отличия есть только у receiver'a
 
             # deliver INFO-4 message to receiver user
             # underlying transport: unreliable with possible repetitions
             # goal: receiver knows all exactly once in the order
             elif msg.type == 'INFO-4':
-                while True:                                                   # для INFO-4 логика такая же, как для INFO-2,
-                    self._comm.send(msg, self._recv_addr)                     # отличия есть только у receiver'a
-                    resp = self._comm.recv(timeout=0.5)
-                    if resp is None:
-                        continue
-                    elif resp.is_local():                                     # порядок сохраняется потому, что новые
-                        self._local_messages.append(resp)                     # локальные сообщения мы не отправляем до тех пор
-                    else:                                                     # пока не получим ответ от receiver'а
-                        resp._sender = msg._sender
-                        if resp == msg:
-                            break
+                self.send_and_wait(msg)                                       # для INFO-4 логика такая же, как для INFO-2,
+                                                                              # отличия есть только у receiver'a;
+                                                                              # порядок сохраняется потому, что новые
+                                                                              # локальные сообщения мы не отправляем до тех пор
+                                                                              # пока не получим ответ от receiver'а
+
+            elif msg.type == 'STATS':
+                stats = self._rto.stats()
+                stats['traffic'] = self.traffic()
+                self._comm.send_local(Message('STATS', stats))
+
+            else:
+                err = Message('ERROR', 'unknown command: %s' % msg.type)
+                self._comm.send_local(err)
+
+    def send_and_wait(self, msg):
+        retransmitted = False
+        while True:                                                 # отправляем и ждём ответ;
+            self.send(msg)                                          # если ответ - сообщение с локального сервера,
+            sent_at = time.time()                                   # то добавляем его в очередь и дальше ждём ответ
+            deadline = sent_at + self._rto.value()                  # от receiver'а (с повторной отправкой по таймауту)
+            while True:
+                resp = self._comm.recv(timeout=max(0, deadline - time.time()))
+                if resp is None:
+                    break
+                elif resp.is_local():
+                    self._local_messages.append(resp)
+                else:
+                    resp._sender = msg._sender
+                    if resp == msg:
+                        if not retransmitted:                       # правило Карна: ответ на повтор не замеряем
+                            self._rto.sample(time.time() - sent_at)
+                        return
+            self._rto.timeout()
+            retransmitted = True
+
+    def send(self, msg):
+        with self._send_lock:
+            self._sent[msg.type] += 1
+            self._bytes += len(json.dumps([msg.type, msg.body, msg.headers]))
+            self._comm.send(msg, self._recv_addr)
 
+    def traffic(self):
+        with self._send_lock:
+            return {'sent': dict(self._sent), 'bytes': self._bytes}
+
+    def run_window(self):
+        # поток run только принимает: локальные сообщения раздаёт в каналы, ACK'и - тому каналу, чей это тип.
+        # Отправка и повторы идут в потоках каналов, INFO-4 тоже отправляем окном: порядок восстанавливает receiver
+        for msg_type in ('INFO-2', 'INFO-3', 'INFO-4'):
+            self._channels[msg_type] = Channel(self.send, self._recv_addr, msg_type, self._window, self._target,
+                                               hold_sacked=(msg_type == 'INFO-4'))
+            self._channels[msg_type].start()
+        while True:
+            msg = self._comm.recv()
+            if not msg.is_local():
+                # ACK receiver'а: [тип, все номера до этого получены, диапазоны полученных номеров выше,
+                #                   сколько номеров после накопительного receiver готов принять]
+                if msg.type == 'ACK' and msg.body[0] in self._channels:
+                    self._channels[msg.body[0]].ack(msg.body[1], msg.body[2], msg.body[3])
+            elif msg.type == 'INFO-1':
+                # номер нужен только receiver'у, чтобы отсеивать повторы
+                self._info1_seq += 1
+                headers = dict(msg.headers or {})
+                headers['seq'] = self._info1_seq
+                self.send(Message(msg.type, msg.body, headers))
+            elif msg.type in self._channels:
+                # очередь канала - единственный буфер: локальные сообщения и ACK'и приходят через один recv,
+                # поэтому перестать читать только локальные нельзя, и не влезшее сообщение отклоняем
+                if not self._channels[msg.type].submit(msg):
+                    self._comm.send_local(Message('ERROR', 'queue is full: %s' % msg.type))
+            elif msg.type == 'STATS':
+                stats = dict((msg_type, channel.stats()) for msg_type, channel in self._channels.items())
+                stats['traffic'] = self.traffic()
+                self._comm.send_local(Message('STATS', stats))
             else:
                 err = Message('ERROR', 'unknown command: %s' % msg.type)
                 self._comm.send_local(err)
@@ -83,12 +430,20 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', dest='recv_addr', metavar='host:port',
                         help='receiver address', default='127.0.0.1:9701')
+    parser.add_argument('-w', dest='window', type=int, default=0,
+                        help='max unacknowledged messages in flight, 0 - stop-and-wait')
+    parser.add_argument('-p', dest='target', type=float, default=None,
+                        help='window mode: send copies so a round is delivered with this probability')
     parser.add_argument('-d', dest='log_level', action='store_const', const=logging.DEBUG,
                         help='print debugging info', default=logging.WARNING)
     args = parser.parse_args()
+    if not 0 <= args.window <= MAX_WINDOW:
+        parser.error('window must be between 0 and %d' % MAX_WINDOW)
+    if args.target is not None and not 0 < args.target < 1:
+        parser.error('delivery probability must be between 0 and 1 (exclusive)')
     logging.basicConfig(format="%(asctime)s - %(message)s", level=args.log_level)
 
-    sender = Sender('sender', args.recv_addr)
+    sender = Sender('sender', args.recv_addr, args.window, args.target)
     sender.run()
 
 
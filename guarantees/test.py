@@ -3,8 +3,11 @@
 import argparse
 import logging
 import os
+import shutil
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import unittest
 
@@ -16,10 +19,11 @@ SERVER_ADDR = '127.0.0.1:9701'
 TEST_SERVER_ADDR = '127.0.0.1:9746'
 
 
-def run_receiver(impl_dir, receiver_addr, ts_addr, debug):
+def run_receiver(impl_dir, receiver_addr, ts_addr, debug, extra_args=()):
     env = os.environ.copy()
     env['TEST_SERVER'] = ts_addr
     cmd = ['/usr/bin/env', 'python3', os.path.join(impl_dir, 'receiver.py'), '-l', receiver_addr]
+    cmd.extend(extra_args)
     if debug:
         cmd.append('-d')
         out = None
@@ -30,10 +34,11 @@ def run_receiver(impl_dir, receiver_addr, ts_addr, debug):
     return process
 
 
-def run_sender(impl_dir, receiver_addr, ts_addr, debug):
+def run_sender(impl_dir, receiver_addr, ts_addr, debug, extra_args=()):
     env = os.environ.copy()
     env['TEST_SERVER'] = ts_addr
     cmd = ['/usr/bin/env', 'python3', os.path.join(impl_dir, 'sender.py')]
+    cmd.extend(extra_args)
     if debug:
         cmd.append('-d')
         out = None
@@ -45,6 +50,9 @@ def run_sender(impl_dir, receiver_addr, ts_addr, debug):
 
 
 class BaseTestCase(unittest.TestCase):
+    sender_args = ()
+    receiver_args = ()
+
     def __init__(self, impl_dir, debug=False):
         super(BaseTestCase, self).__init__()
         self.impl_dir = impl_dir
@@ -56,8 +64,8 @@ class BaseTestCase(unittest.TestCase):
 
         self.ts = TestServer(TEST_SERVER_ADDR)
         self.ts.start()
-        self.receiver = run_receiver(self.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, self.debug)
-        self.sender = run_sender(self.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, self.debug)
+        self.receiver = run_receiver(self.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, self.debug, self.receiver_args)
+        self.sender = run_sender(self.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, self.debug, self.sender_args)
 
     def tearDown(self):
         self.sender.terminate()
@@ -320,6 +328,124 @@ class RandomTEST4(BaseTestCase):
         self.assertIsNone(sender_resp)
 
 
+class WindowTEST4(BaseTestCase):
+    """INFO-4 в режиме окна: несколько сообщений в полёте, порядок восстанавливает receiver."""
+    sender_args = ('-w', '4')
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(2, 1), "Startup timeout")
+        num_messages = 20
+        self.ts.set_repeat_rate(1, 1)
+        self.ts.set_event_reordering(True)
+        self.ts.set_message_drop_rate(0.5)
+
+        for i in range(num_messages):
+            self.ts.send_local_message('sender', Message('INFO-4', str(i)), 1)
+        messages = []
+        while True:
+            sender_resp = self.ts.step_until_local_message('receiver', 1)
+            if sender_resp is None:
+                break
+            messages.append(sender_resp)
+        # все сообщения ровно один раз и в порядке отправки
+        self.assertEqual([msg.type for msg in messages], ['INFO-4'] * num_messages)
+        self.assertListEqual([msg.body for msg in messages], [str(i) for i in range(num_messages)])
+
+
+class RestartWindowTEST4(BaseTestCase):
+    """INFO-4 в режиме окна: receiver перезапускается без журнала и дальше доставляет новые сообщения по порядку."""
+    sender_args = ('-w', '4')
+
+    def send_and_collect(self, bodies):
+        for body in bodies:
+            self.ts.send_local_message('sender', Message('INFO-4', body), 1)
+        messages = []
+        while True:
+            sender_resp = self.ts.step_until_local_message('receiver', 1)
+            if sender_resp is None:
+                return messages
+            messages.append(sender_resp.body)
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(2, 1), "Startup timeout")
+        self.ts.set_message_drop_rate(0.3)
+        before = [str(i) for i in range(10)]
+        self.assertListEqual(self.send_and_collect(before), before)
+
+        self.receiver.kill()
+        self.receiver.wait()
+        self.receiver = run_receiver(self.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, self.debug)
+        self.assertTrue(self.ts.wait_processes(2, 5), "Restart timeout")
+        # новый receiver не знает прежних номеров, но sender сообщает, что до них всё уже подтверждено
+        after = [str(i) for i in range(10, 20)]
+        self.assertListEqual(self.send_and_collect(after), after)
+
+
+class LogTestCase(BaseTestCase):
+    """Базовый класс для receiver'а с журналом номеров (-s) во временном каталоге."""
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp(prefix='receiver-log-')
+        self.log_path = os.path.join(self.log_dir, 'receiver.log')
+        self.receiver_args = ('-s', self.log_path)
+        super(LogTestCase, self).setUp()
+
+    def tearDown(self):
+        super(LogTestCase, self).tearDown()
+        shutil.rmtree(self.log_dir, ignore_errors=True)
+
+    def collect(self, msg_type):
+        bodies = []
+        while True:
+            sender_resp = self.ts.step_until_local_message('receiver', 1)
+            if sender_resp is None:
+                return bodies
+            self.assertEqual(sender_resp.type, msg_type)
+            bodies.append(sender_resp.body)
+
+
+class StopAndWaitLogTEST3(LogTestCase):
+    """Receiver с журналом и sender без окна: сообщения без номера доставляются сразу и ровно один раз."""
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(2, 1), "Startup timeout")
+        self.ts.set_repeat_rate(1, 1)
+        self.ts.set_message_drop_rate(0.3)
+        for i in range(10):
+            self.ts.send_local_message('sender', Message('INFO-3', str(i)), 1)
+        self.assertListEqual(sorted(self.collect('INFO-3'), key=int), [str(i) for i in range(10)])
+
+
+class RestartLogWindowTEST3(LogTestCase):
+    """Receiver с журналом перезапускается: повторы, чей ACK потерялся, не доставляются второй раз;
+    разросшийся журнал сжимается и после сжатия читается заново."""
+    sender_args = ('-w', '4')
+
+    def setUp(self):
+        super(RestartLogWindowTEST3, self).setUp()
+        # журнал, который давно пора сжать: больше 1 МБ устаревших записей (INFO-3, watermark 0, пустая маска)
+        with open(self.log_path, 'wb') as f:
+            f.write(struct.pack('<BQI', 2, 0, 0) * (((1 << 20) // struct.calcsize('<BQI')) + 1))
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(2, 1), "Startup timeout")
+        self.ts.set_repeat_rate(1, 1)
+        self.ts.set_message_drop_rate(0.3)
+        for i in range(10):
+            self.ts.send_local_message('sender', Message('INFO-3', str(i)), 1)
+        before = self.collect('INFO-3')
+        self.assertLess(os.path.getsize(self.log_path), 1 << 20, "Log is not compacted")
+
+        self.receiver.kill()
+        self.receiver.wait()
+        self.receiver = run_receiver(self.impl_dir, SERVER_ADDR, TEST_SERVER_ADDR, self.debug, self.receiver_args)
+        self.assertTrue(self.ts.wait_processes(2, 5), "Restart timeout")
+        for i in range(10, 20):
+            self.ts.send_local_message('sender', Message('INFO-3', str(i)), 1)
+        after = self.collect('INFO-3')
+        self.assertListEqual(sorted(before + after, key=int), [str(i) for i in range(20)])
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(dest='impl_dir', metavar='DIRECTORY',
@@ -351,6 +477,14 @@ def main():
         TEST4(
             args.impl_dir, args.debug),
         RandomTEST4(
+            args.impl_dir, args.debug),
+        WindowTEST4(
+            args.impl_dir, args.debug),
+        RestartWindowTEST4(
+            args.impl_dir, args.debug),
+        StopAndWaitLogTEST3(
+            args.impl_dir, args.debug),
+        RestartLogWindowTEST3(
             args.impl_dir, args.debug)
     ]
 
@@ -1,37 +1,446 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import collections.abc
 import hashlib
+import itertools
 import logging
+import math
+import mmap
+import os
 import random
+import re
+import tempfile
+import time
 
 from dslib import Message, Process, Runtime
 
 
+TICK = 0.1                                  # период одного тика колеса таймеров (секунды)
+TTL_SUFFIX = re.compile(r'^(.*);(\d+(?:\.\d+)?)$', re.DOTALL)   # "value;ttl": TTL - только число в самом конце
+GET_TIMEOUT = 1                             # через сколько секунд пересылаем GET заново, если ответа нет
+GET_RETRIES = 3                             # после стольких пересылок без ответа отвечаем пустой строкой
+PUT_WINDOW = 0.05                           # окно, в котором PUT'ы одного ключа склеиваются в один
+VIEW_LOG_SIZE = 64                          # сколько последних изменений состава группы помним для REDIRECT
+LOAD_PERIOD = 5                             # период замера и рассылки нагрузки (секунды)
+MIN_RATE = 50                               # средняя нагрузка (запросов/с), ниже которой веса не трогаем
+LOAD_TOLERANCE = 0.25                       # допустимое отклонение нагрузки node'ы от средней
+MAX_WEIGHT_STEP = 0.1                       # на сколько максимум меняется вес за один период (бюджет перемещения)
+MIN_WEIGHT, MAX_WEIGHT = 0.5, 2.0
+COMPACT_PERIOD = 10                         # как часто проверяем, не пора ли сжать файл значений (секунды)
+COMPACT_MIN_BYTES = 1 << 20                 # файл меньше этого размера не сжимаем
+
+
+class TimerWheel:
+    """Иерархическое колесо таймеров.
+
+    Время измеряется в тиках: каждый уровень состоит из `slots` ячеек и покрывает в `slots` раз больший интервал,
+    чем предыдущий. Записи верхних уровней спускаются вниз (cascade), когда до них доходит очередь, поэтому
+    добавление и срабатывание стоят O(1) амортизированно, без просмотра всех записей.
+    """
+
+    def __init__(self, slots=64, levels=4):
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._levels = [[list() for _ in range(slots)] for _ in range(levels)]
+        self._span = 1 << (self._bits * levels)
+        self._now = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def now(self):
+        return self._now
+
+    def add(self, key, expire):
+        delta = max(expire - self._now, 0)
+        level = 0
+        while level < len(self._levels) - 1 and delta >= (1 << (self._bits * (level + 1))):
+            level += 1
+        # слишком далёкие записи кладём в последнюю ячейку верхнего уровня, при спуске они встанут на место
+        slot_expire = min(expire, self._now + self._span - 1)
+        slot = (slot_expire >> (self._bits * level)) & self._mask
+        self._levels[level][slot].append((key, expire))
+        self._size += 1
+
+    def tick(self):
+        """Сдвигает колесо на один тик и возвращает список записей (key, expire), срок которых наступил."""
+        self._now += 1
+
+        # спускаем записи с верхних уровней, начиная с самого старшего
+        level = 1
+        while level < len(self._levels) and not self._now & ((1 << (self._bits * level)) - 1):
+            level += 1
+        for level in reversed(range(1, level)):
+            slot = (self._now >> (self._bits * level)) & self._mask
+            entries = self._levels[level][slot]
+            self._levels[level][slot] = list()
+            self._size -= len(entries)
+            for key, expire in entries:
+                self.add(key, expire)
+
+        slot = self._now & self._mask
+        expired = self._levels[0][slot]
+        self._levels[0][slot] = list()
+        self._size -= len(expired)
+        return expired
+
+
+class ValueLog:
+    """Файл значений, в который только дописывают; читается через mmap."""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'w+b')
+        self._map = None
+        self.size = 0
+        self.dead = 0                     # байты значений, которые уже перезаписаны или удалены
+
+    def append(self, data):
+        offset = self.size
+        self._file.write(data)
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        if self._map is None or len(self._map) < offset + length:
+            # файл вырос с прошлого отображения - отображаем заново
+            self._file.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length]
+
+    def compact(self, entries):
+        """Переписывает в новый файл только живые записи entries (ключ -> (offset, length)), возвращает их новые offset'ы."""
+        new_file = open(self._path + '.compact', 'w+b')
+        new_entries = dict()
+        new_size = 0
+        for key, (offset, length) in entries.items():
+            new_file.write(self.read(offset, length))
+            new_entries[key] = (new_size, length)
+            new_size += length
+        new_file.flush()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        os.replace(self._path + '.compact', self._path)
+        self._file = new_file
+        self.size = new_size
+        self.dead = 0
+        return new_entries
+
+    def clear(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.truncate(0)
+        self._file.seek(0)
+        self.size = 0
+        self.dead = 0
+
+
+class SpillDict(collections.abc.MutableMapping):
+    """Словарь key -> value с ограничением памяти на значения.
+
+    Когда значения в памяти занимают больше `budget` байт, давно не использованные значения уходят в `ValueLog`,
+    а в памяти остаются только их ключи и offset'ы. При обращении значение читается из файла и снова становится
+    горячим.
+    """
+
+    def __init__(self, budget, path):
+        self._budget = budget
+        self._hot = collections.OrderedDict()      # ключ -> значение, в порядке последнего использования
+        self._hot_bytes = 0
+        self._cold = dict()                         # ключ -> (offset, length) в файле значений
+        self._log = ValueLog(path)
+
+    def __contains__(self, key):
+        return key in self._hot or key in self._cold
+
+    def __getitem__(self, key):
+        if key in self._hot:
+            self._hot.move_to_end(key)
+            return self._hot[key]
+        offset, length = self._cold.pop(key)
+        value = self._log.read(offset, length).decode()
+        self._log.dead += length
+        self._put_hot(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        self._put_hot(key, value)
+
+    def __delitem__(self, key):
+        if key in self._hot:
+            self._hot_bytes -= len(self._hot.pop(key))
+        else:
+            self._log.dead += self._cold.pop(key)[1]
+
+    def __iter__(self):
+        # по снимку ключей: чтение значения переставляет _hot и переносит ключ из _cold
+        return iter(list(itertools.chain(self._hot, self._cold)))
+
+    def __len__(self):
+        return len(self._hot) + len(self._cold)
+
+    def peek(self, key):
+        # значение без перевода в горячие: обход всех записей не должен вытеснять из памяти нужные
+        if key in self._hot:
+            return self._hot[key]
+        offset, length = self._cold[key]
+        return self._log.read(offset, length).decode()
+
+    def items(self):
+        return [(key, self.peek(key)) for key in self]
+
+    def values(self):
+        return [self.peek(key) for key in self]
+
+    def pop(self, key, *default):
+        # без перевода значения в горячие - оно всё равно удаляется
+        if key in self._hot:
+            value = self._hot.pop(key)
+            self._hot_bytes -= len(value)
+            return value
+        if key in self._cold:
+            offset, length = self._cold.pop(key)
+            self._log.dead += length
+            return self._log.read(offset, length).decode()
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def clear(self):
+        self._hot.clear()
+        self._hot_bytes = 0
+        self._cold.clear()
+        self._log.clear()
+
+    def _put_hot(self, key, value):
+        self._hot[key] = value
+        self._hot_bytes += len(value)
+        # самое свежее значение всегда остаётся в памяти
+        while self._hot_bytes > self._budget and len(self._hot) > 1:
+            cold_key, cold_value = self._hot.popitem(last=False)
+            self._hot_bytes -= len(cold_value)
+            data = cold_value.encode()
+            self._cold[cold_key] = (self._log.append(data), len(data))
+
+    def compact(self):
+        if self._log.size >= COMPACT_MIN_BYTES and self._log.dead * 2 > self._log.size:
+            self._cold = self._log.compact(self._cold)
+
+
 class Node(Process):
-    def __init__(self, name):
+    def __init__(self, name, memory_budget=None, spill_path=None):
         super().__init__(name)
         self._group = dict()
         self._alive_list = set()
         self._failed_list = set()
         self._k = 5
         self._checking_node = None
-        self._data = dict()
-
-    def target_node(self, key):
+        if memory_budget is None:
+            self._data = dict()
+        else:
+            if spill_path is None:
+                spill_path = os.path.join(tempfile.gettempdir(), 'kv-node-%s.log' % name)
+            self._data = SpillDict(memory_budget, spill_path)
+        self._expires = dict()            # ключ -> тик, на котором запись истекает (только для записей с TTL)
+        self._wheel = TimerWheel()
+        self._pending_gets = dict()       # ключ -> число локальных GET'ов, ждущих ответа на одну пересылку
+        self._get_attempts = dict()       # ключ -> сколько раз переслали GET владельцу
+        self._pending_puts = dict()       # ключ -> (value, срок жизни или None) последнего PUT'а, ещё не
+                                          # отправленного владельцу; срок - по time.monotonic()
+        self._epoch = 0                   # номер версии состава группы, общий для всей группы (расходится gossip'ом)
+        self._view = set()                # состав группы, которому соответствует текущая эпоха
+        self._view_log = collections.deque(maxlen=VIEW_LOG_SIZE)    # (epoch, addr, name или None если node'а ушла)
+        self._weights = dict()            # адрес -> вес node'ы в rendezvous hashing (по умолчанию 1.0)
+        self._load = dict()               # адрес -> [номер замера, запросов/с, байт хранится, вес]
+        self._load_round = 0
+        self._requests = 0                # число запросов, обслуженных с последнего замера
+        self._bytes = 0                   # сколько байт занимают хранимые записи
+
+    def target_node(self, key, exclude=None):
         target_node = None
-        max_hash = 0
+        max_score = 0
         for node_addr in list(self._alive_list):
+            if node_addr == exclude:
+                continue
             temp_str = key + node_addr
             h = hashlib.md5(temp_str.encode())
             hash_number = (int.from_bytes(h.digest(), byteorder='little'))
-            if hash_number > max_hash:
-                max_hash = hash_number
+            # weighted rendezvous hashing: при равных весах выбирается node'а с максимальным хэшем, как и раньше
+            score = -self._weights.get(node_addr, 1.0) / math.log((hash_number + 1) / (2 ** 128 + 1))
+            if score > max_score:
+                max_score = score
                 target_node = node_addr
         return target_node
 
-    def receive(self, ctx, msg):
+    def store(self, ctx, key, value, ttl=None):
+        self.discard(key)
+        if ttl is not None and ttl <= 0:
+            # ";0" (или PUT, истёкший по дороге к владельцу) удаляет запись, как DELETE, на любом пути
+            return
+        self._data[key] = value
+        self._bytes += len(key) + len(value)
+        if ttl is None:
+            self._expires.pop(key, None)
+            return
+        # округляем вниз, чтобы запись никогда не пережила свой TTL
+        expire = self._wheel.now() + max(1, int(ttl / TICK))
+        self._expires[key] = expire
+        if len(self._wheel) == 0:
+            ctx.set_timer('expiryTick', TICK)
+        self._wheel.add(key, expire)
+
+    def discard(self, key):
+        self._expires.pop(key, None)
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._bytes -= len(key) + len(value)
+        return value
+
+    def has_key(self, key):
+        if key not in self._data:
+            return False
+        if self._expires.get(key, self._wheel.now() + 1) <= self._wheel.now():
+            self.discard(key)
+            return False
+        return True
+
+    def pending_alive(self, key):
+        # PUT ещё не отправлен владельцу, но TTL у него уже мог истечь
+        deadline = self._pending_puts[key][1]
+        return deadline is None or deadline > time.monotonic()
+
+    def ttl_left(self, key):
+        if key not in self._expires:
+            return None
+        return (self._expires[key] - self._wheel.now()) * TICK
+
+    def forward_get(self, ctx, key):
+        self._get_attempts[key] = self._get_attempts.get(key, 0) + 1
+        ctx.send(Message('GET', body=[key, self._epoch]), self.target_node(key))
+        ctx.set_timer('getTimeout:' + key, GET_TIMEOUT)
+
+    def flush_put(self, ctx, key):
+        value, deadline = self._pending_puts.pop(key)
+        ctx.cancel_timer('flushPut:' + key)
+        # истёкший PUT тоже отправляем: он перекрывает старое значение, и владелец удалит запись
+        ttl = None if deadline is None else deadline - time.monotonic()
+        ctx.send(Message('PUT_IN_YOUR_DATA', body=[key, value, ttl, self._epoch]), self.target_node(key))
+
+    def transfer(self, ctx, key, target):
+        new_msg = Message('PUT_IN_YOUR_DATA', body=[key, self._data[key], self.ttl_left(key), self._epoch])
+        ctx.send(new_msg, target)
+
+    def rebalance(self, ctx):
+        for key in list(self._data.keys()):
+            target = self.target_node(key)
+            if target != ctx.addr():
+                if self.has_key(key):
+                    self.transfer(ctx, key, target)
+                self.discard(key)
+
+    def update_epoch(self, seen=0):
+        # seen - эпоха из пришедшего сообщения о составе группы; если состав изменился, начинается новая эпоха,
+        # больше всех уже известных, иначе просто догоняем эпоху отправителя
+        if self._view == self._alive_list:
+            self._epoch = max(self._epoch, seen)
+            return
+        self._epoch = max(self._epoch, seen) + 1
+        for addr in self._alive_list - self._view:
+            self._view_log.append((self._epoch, addr, self._group.get(addr, addr)))
+        for addr in self._view - self._alive_list:
+            self._view_log.append((self._epoch, addr, None))
+        self._view = set(self._alive_list)
+
+    def view_delta(self, since):
+        if self._epoch <= since:
+            # наш состав группы не новее, чем у отправителя, - учить его нечему
+            return []
+        if len(self._view_log) == self._view_log.maxlen and self._view_log[0][0] > since:
+            # нужная часть истории уже забыта - отдаём состав группы целиком
+            return [(self._epoch, addr, self._group.get(addr, addr)) for addr in self._alive_list] + \
+                   [(self._epoch, addr, None) for addr in self._failed_list]
+        return [entry for entry in self._view_log if entry[0] > since]
+
+    def apply_view(self, ctx, delta):
+        for epoch, addr, name in delta:
+            # не берём изменений старше своей эпохи и не воскрешаем node'ы, про отказ которых уже знаем
+            if addr == ctx.addr() or epoch <= self._epoch or (name is not None and addr in self._failed_list):
+                continue
+            if name is None:
+                self._group.pop(addr, 0)
+                self._alive_list.discard(addr)
+                self._failed_list.add(addr)
+            else:
+                self._group[addr] = name
+                self._alive_list.add(addr)
+                self._failed_list.discard(addr)
+
+    def set_weights(self, ctx, weights):
+        changed = False
+        for addr, weight in weights.items():
+            if addr != ctx.addr() and self._weights.get(addr, 1.0) != weight:
+                self._weights[addr] = weight
+                changed = True
+        if changed:
+            # веса меняют владельцев ключей так же, как изменение состава группы
+            self._epoch += 1
+            self.rebalance(ctx)
+
+    def report_load(self, ctx):
+        self._load_round += 1
+        weight = self._weights.get(ctx.addr(), 1.0)
+        self._load[ctx.addr()] = [self._load_round, self._requests / LOAD_PERIOD, self._bytes, weight]
+        self._requests = 0
+
+        loads = [self._load[addr] for addr in self._alive_list if addr in self._load]
+        avg_rate = sum(load[1] for load in loads) / max(len(loads), 1)
+        avg_bytes = sum(load[2] for load in loads) / max(len(loads), 1)
+        new_weight = weight
+        if len(loads) > 1 and avg_rate >= MIN_RATE:
+            score = self._load[ctx.addr()][1] / avg_rate
+            if score > 1 + LOAD_TOLERANCE:
+                new_weight = weight * max(1 - MAX_WEIGHT_STEP, 1 / score)
+            elif score < 1 - LOAD_TOLERANCE and self._bytes <= (1 + LOAD_TOLERANCE) * avg_bytes:
+                # недогруженная node'а берёт больше ключей, только если у неё не слишком много данных
+                new_weight = weight * min(1 + MAX_WEIGHT_STEP, 1 / max(score, 1 - MAX_WEIGHT_STEP))
+            new_weight = min(MAX_WEIGHT, max(MIN_WEIGHT, new_weight))
+        if new_weight != weight:
+            self._weights[ctx.addr()] = new_weight
+            self._load[ctx.addr()][3] = new_weight
+            self._epoch += 1
+            self.rebalance(ctx)
+
+        new_msg = Message('LOAD', body=[self._load, self._epoch])
+        for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
+            ctx.send(new_msg, member)
+
+    def request_owner(self, ctx, msg):
+        # отправитель уже решил, что ключ не его (например, он уходит из группы), - о себе он знает лучше нас;
+        # запрос самой себе (после REDIRECT владельцем оказались мы) так не считаем
+        exclude = msg.sender if msg.sender != ctx.addr() else None
+        return self.target_node(msg.body[0], exclude=exclude)
+
+    def is_stale(self, ctx, msg):
+        # запрос пришёл не по адресу: по нашему составу группы ключ принадлежит другой node'е
+        return self.request_owner(ctx, msg) != ctx.addr()
+
+    def redirect(self, ctx, msg, epoch):
+        owner = self.request_owner(ctx, msg)
+        weights = self._weights if self._epoch > epoch else dict()
+        new_msg = Message('REDIRECT', body=[msg.type, msg.body, self._epoch, self.view_delta(epoch), owner, weights])
+        ctx.send(new_msg, msg.sender)
 
+    def receive(self, ctx, msg):
         if msg.is_local():
 
             # Client commands (API) ***************************************************************
@@ -42,6 +451,9 @@ class Node(Process):
             if msg.type == 'JOIN':
                 ctx.set_timer('checkLive', 2)
                 ctx.set_timer('checkDead', 10)
+                ctx.set_timer('loadReport', LOAD_PERIOD)
+                if isinstance(self._data, SpillDict):
+                    ctx.set_timer('compactLog', COMPACT_PERIOD)
                 seed = msg.body
                 if seed == ctx.addr():
                     # create new empty group and add local node to it
@@ -57,7 +469,8 @@ class Node(Process):
                     # join existing group
                     self._group[ctx.addr()] = self.name
                     self._alive_list.add(ctx.addr())
-                    new_msg = Message('JOIN', body=self._group)
+                    self.update_epoch()
+                    new_msg = Message('JOIN', body=[self._group, self._epoch])
                     ctx.send(new_msg, seed)
 
             # Remove node from the system
@@ -65,19 +478,24 @@ class Node(Process):
             # - response: none
             elif msg.type == 'LEAVE':
                 self._alive_list.discard(ctx.addr())
+                for key in list(self._pending_puts.keys()):
+                    self.flush_put(ctx, key)
                 for key in list(self._data.keys()):
-                    target = self.target_node(key)
-                    data = [key, self._data[key]]
-                    new_msg = Message('PUT_IN_YOUR_DATA', body=data)
-                    ctx.send(new_msg, target)
+                    if self.has_key(key):
+                        self.transfer(ctx, key, self.target_node(key))
 
-                new_msg = Message('LEAVE', body=ctx.addr())
+                self.update_epoch()
+                new_msg = Message('LEAVE', body=[ctx.addr(), self._epoch])
                 for member in list(self._alive_list):
                     ctx.send(new_msg, member)
                 self._data.clear()
+                self._expires.clear()
                 self._group.clear()
                 self._alive_list.clear()
                 self._failed_list.clear()
+                # в журнале остаётся только наш уход: REDIRECT'ы опоздавшим запросам не должны удалять из группы
+                # остальные node'ы
+                self._view = set()
 
             # Get a list of nodes in the system
             # - request body: none
@@ -90,29 +508,46 @@ class Node(Process):
             # - reponse: GET_RESP message, body contains value or empty string if record is not found
             elif msg.type == 'GET':
                 key = msg.body
-                if key in self._data:
+                if self.has_key(key):
+                    self._requests += 1
                     new_msg = Message('GET_RESP', body=self._data[key])
                     ctx.send_local(new_msg)
+                elif key in self._pending_puts:
+                    # последний PUT перекрывает значение у владельца, даже если уже истёк
+                    value = self._pending_puts[key][0] if self.pending_alive(key) else ''
+                    new_msg = Message('GET_RESP', body=value)
+                    ctx.send_local(new_msg)
+                elif key in self._pending_gets:
+                    # такой GET уже переслан владельцу - ждём его ответа вместе со всеми
+                    self._pending_gets[key] += 1
                 else:
-                    target = self.target_node(key)
-                    new_msg = Message('GET', body=key)
-                    ctx.send(new_msg, target)
+                    self._pending_gets[key] = 1
+                    self.forward_get(ctx, key)
 
             # Store value for the key
-            # - request body: string "key=value"
+            # - request body: string "key=value" or "key=value;ttl" (ttl in seconds)
             # - response: PUT_RESP message, body is empty
             elif msg.type == 'PUT':
                 key_and_value = msg.body.split('=')
                 key = key_and_value[0]
-                value = key_and_value[1]
+                # ";" без числа после него - часть значения, как и раньше
+                value, ttl = key_and_value[1], None
+                match = TTL_SUFFIX.match(value)
+                if match is not None:
+                    value, ttl = match.group(1), float(match.group(2))
 
                 target = self.target_node(key)
 
                 if target == ctx.addr():
-                    self._data[key] = value
+                    if self._pending_puts.pop(key, None) is not None:
+                        ctx.cancel_timer('flushPut:' + key)
+                    self._requests += 1
+                    self.store(ctx, key, value, ttl)
                 else:
-                    new_msg = Message('PUT_IN_YOUR_DATA', body=[key, value])
-                    ctx.send(new_msg, target)
+                    # отправляем владельцу только последнее значение, пришедшее за окно PUT_WINDOW
+                    if key not in self._pending_puts:
+                        ctx.set_timer('flushPut:' + key, PUT_WINDOW)
+                    self._pending_puts[key] = (value, None if ttl is None else time.monotonic() + ttl)
 
                 ctx.set_timer('PUT_RESP', 0.2)
 
@@ -121,11 +556,15 @@ class Node(Process):
             # - response: DELETE_RESP message, body is empty
             elif msg.type == 'DELETE':
                 key = msg.body
+                if key in self._pending_puts:
+                    self._pending_puts.pop(key)
+                    ctx.cancel_timer('flushPut:' + key)
                 if key in self._data:
-                    self._data.pop(key, 0)
+                    self._requests += 1
+                    self.discard(key)
                 else:
                     target = self.target_node(key)
-                    new_msg = Message('DELETE', body=key)
+                    new_msg = Message('DELETE', body=[key, self._epoch])
                     ctx.send(new_msg, target)
                 ctx.set_timer('DELETE_RESP', 0.2)
 
@@ -134,7 +573,7 @@ class Node(Process):
             # - response: LOOKUP_RESP message, body contains the node name
             elif msg.type == 'LOOKUP':
                 key = msg.body
-                if key in self._data:
+                if self.has_key(key):
                     new_msg = Message('LOOKUP_RESP', body=self.name)
                     ctx.send_local(new_msg)
                 else:
@@ -167,56 +606,93 @@ class Node(Process):
             # You can introduce any messages for node-to-node communcation
 
             if msg.type == 'PUT_IN_YOUR_DATA':
-                self._data[msg.body[0]] = msg.body[1]
+                key, value, ttl, epoch = msg.body
+                if self.is_stale(ctx, msg):
+                    self.redirect(ctx, msg, epoch)
+                else:
+                    self._requests += 1
+                    self.store(ctx, key, value, ttl)
 
             elif msg.type == 'GET':
-                key = msg.body
-                if key in self._data:
-                    new_msg = Message('GIVE_YOU_DATA', body=self._data[key])
+                key, epoch = msg.body
+                if self.is_stale(ctx, msg):
+                    self.redirect(ctx, msg, epoch)
+                elif self.has_key(key):
+                    self._requests += 1
+                    new_msg = Message('GIVE_YOU_DATA', body=[key, self._data[key]])
                     ctx.send(new_msg, msg.sender)
                 else:
-                    new_msg = Message('GIVE_YOU_DATA', body='')
+                    self._requests += 1
+                    new_msg = Message('GIVE_YOU_DATA', body=[key, ''])
                     ctx.send(new_msg, msg.sender)
 
             elif msg.type == 'GIVE_YOU_DATA':
-                new_msg = Message('GET_RESP', body=msg.body)
-                ctx.send_local(new_msg)
+                key, value = msg.body
+                ctx.cancel_timer('getTimeout:' + key)
+                self._get_attempts.pop(key, None)
+                # отвечаем всем локальным GET'ам, которые ждали эту пересылку
+                for _ in range(self._pending_gets.pop(key, 0)):
+                    new_msg = Message('GET_RESP', body=value)
+                    ctx.send_local(new_msg)
 
             elif msg.type == 'DELETE':
-                key = msg.body
-                if key in self._data:
-                    self._data.pop(key)
+                key, epoch = msg.body
+                if self.is_stale(ctx, msg):
+                    self.redirect(ctx, msg, epoch)
+                else:
+                    self._requests += 1
+                    self.discard(key)
+
+            # получатель запроса не владелец ключа по своему составу группы: если его состав новее, догоняем его,
+            # и пересылаем запрос заново
+            elif msg.type == 'REDIRECT':
+                req_type, req_body, epoch, delta, owner, weights = msg.body
+                if len(self._alive_list) > 0:
+                    if epoch > self._epoch:
+                        self.apply_view(ctx, delta)
+                        self.set_weights(ctx, weights)
+                        self.update_epoch(epoch)
+                        self.rebalance(ctx)
+                    if self.target_node(req_body[0]) != msg.sender:
+                        # иначе составы ещё не сошлись - верим владельцу, которого назвал отправивший REDIRECT
+                        owner = self.target_node(req_body[0])
+                new_msg = Message(req_type, body=req_body[:-1] + [self._epoch])
+                ctx.send(new_msg, owner)
 
             elif msg.type == 'JOIN':
-                if self._group != msg.body:
-                    self._group.update(msg.body)
-                    temp = set(list(msg.body.keys()))
+                group, epoch = msg.body
+                if self._group != group:
+                    self._group.update(group)
+                    temp = set(list(group.keys()))
                     self._alive_list.update(temp)
 
-                    for key in list(self._data.keys()):
-                        target = self.target_node(key)
-                        if target != ctx.addr():
-                            new_msg = Message('PUT_IN_YOUR_DATA', body=[key, self._data[key]])
-                            ctx.send(new_msg, target)
-                            self._data.pop(key)
+                    self.rebalance(ctx)
 
                     self._failed_list.difference_update(temp)
-                    new_msg = Message('JOIN', body=self._group)
+                    self.update_epoch(epoch)
+                    new_msg = Message('JOIN', body=[self._group, self._epoch])
                     for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
                         ctx.send(new_msg, member)
+                else:
+                    self.update_epoch(epoch)
 
             elif msg.type == 'LEAVE':
-                if msg.body in self._alive_list or msg.body in self._failed_list:
-                    self._group.pop(msg.body, 0)
-                    self._alive_list.discard(msg.body)
-                    self._failed_list.discard(msg.body)
+                addr, epoch = msg.body
+                if addr in self._alive_list or addr in self._failed_list:
+                    self._group.pop(addr, 0)
+                    self._alive_list.discard(addr)
+                    self._failed_list.discard(addr)
+                    self.update_epoch(epoch)
+                    new_msg = Message('LEAVE', body=[addr, self._epoch])
                     for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
-                        ctx.send(msg, member)
+                        ctx.send(new_msg, member)
+                else:
+                    self.update_epoch(epoch)
 
             elif msg.type == 'ARE YOU OKAY?':
                 new_msg = Message('I AM OKAY', body=(ctx.addr(), self.name))
                 ctx.send(new_msg, msg.body)
-                new_msg = Message('JOIN', body=self._group)
+                new_msg = Message('JOIN', body=[self._group, self._epoch])
                 for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
                     ctx.send(new_msg, member)
 
@@ -227,29 +703,44 @@ class Node(Process):
                     ctx.set_timer('checkLive', 2)
 
             elif msg.type == 'ARE YOU LIVE?':
-                new_msg = Message('I LIVE', body=self._group)
+                new_msg = Message('I LIVE', body=[self._group, self._epoch])
                 ctx.send(new_msg, msg.body)
 
             elif msg.type == 'I LIVE':
-                self._group.update(msg.body)
-                temp = set(list(msg.body.keys()))
+                group, epoch = msg.body
+                self._group.update(group)
+                temp = set(list(group.keys()))
                 self._alive_list.update(temp)
                 self._failed_list.difference_update(temp)
+                self.update_epoch(epoch)
 
-                new_msg = Message('JOIN', body=self._group)
+                new_msg = Message('JOIN', body=[self._group, self._epoch])
                 for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
                     ctx.send(new_msg, member)
 
             elif msg.type == 'HE IS DEAD':
-                self._group.pop(msg.body, 0)
-                self._alive_list.discard(msg.body)
-                self._failed_list.add(msg.body)
-                new_msg = Message('KILL HIM', body=list(self._failed_list))
+                addr, epoch = msg.body
+                self._group.pop(addr, 0)
+                self._alive_list.discard(addr)
+                self._failed_list.add(addr)
+                self.update_epoch(epoch)
+                new_msg = Message('KILL HIM', body=[list(self._failed_list), self._epoch])
                 for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
                     ctx.send(new_msg, member)
 
+            elif msg.type == 'LOAD':
+                loads, epoch = msg.body
+                self.update_epoch(epoch)
+                weights = dict()
+                for addr, load in loads.items():
+                    if addr != ctx.addr() and (addr not in self._load or self._load[addr][0] < load[0]):
+                        self._load[addr] = load
+                        weights[addr] = load[3]
+                self.set_weights(ctx, weights)
+
             elif msg.type == 'KILL HIM':
-                temp = set(msg.body)
+                failed, epoch = msg.body
+                temp = set(failed)
                 if self._failed_list != temp:
                     temp = temp.difference(self._failed_list)
                     if len(temp) > 0:
@@ -257,14 +748,19 @@ class Node(Process):
                             self._group.pop(member, 0)
                         self._alive_list.difference_update(temp)
                         self._failed_list.update(temp)
-                    new_msg = Message('KILL HIM', body=list(self._failed_list))
+                    self.update_epoch(epoch)
+                    new_msg = Message('KILL HIM', body=[list(self._failed_list), self._epoch])
                     for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
                         ctx.send(new_msg, member)
+                else:
+                    self.update_epoch(epoch)
 
             else:
                 err = Message('ERROR', 'unknown message: %s' % msg.type)
                 ctx.send(err, msg.sender)
 
+        self.update_epoch()
+
     def on_timer(self, ctx, timer):
         if timer == 'checkLive':
             if len(self._alive_list) > 0:
@@ -278,7 +774,8 @@ class Node(Process):
                 self._failed_list.add(self._checking_node)
                 self._alive_list.discard(self._checking_node)
                 self._group.pop(self._checking_node, 0)
-                new_msg = Message('HE IS DEAD', body=self._checking_node)
+                self.update_epoch()
+                new_msg = Message('HE IS DEAD', body=[self._checking_node, self._epoch])
                 for member in random.sample(list(self._alive_list), min(self._k, len(list(self._group.keys())))):
                     ctx.send(new_msg, member)
             ctx.set_timer('checkLive', 2)
@@ -290,6 +787,37 @@ class Node(Process):
                 ctx.send(new_msg, seed)
             ctx.set_timer('checkDead', 10)
 
+        if timer == 'loadReport':
+            if len(self._alive_list) > 0:
+                self.report_load(ctx)
+            ctx.set_timer('loadReport', LOAD_PERIOD)
+
+        if timer == 'compactLog':
+            self._data.compact()
+            ctx.set_timer('compactLog', COMPACT_PERIOD)
+
+        if timer == 'expiryTick':
+            for key, expire in self._wheel.tick():
+                if self._expires.get(key) == expire:        # запись могли перезаписать или удалить
+                    self.discard(key)
+            if len(self._wheel) > 0:
+                ctx.set_timer('expiryTick', TICK)
+
+        if timer.startswith('getTimeout:'):
+            key = timer[len('getTimeout:'):]
+            if key in self._pending_gets and self._get_attempts.get(key, 0) >= GET_RETRIES:
+                # владелец так и не ответил - не пересылаем бесконечно, а отвечаем, что записи нет
+                self._get_attempts.pop(key)
+                for _ in range(self._pending_gets.pop(key)):
+                    ctx.send_local(Message('GET_RESP', body=''))
+            elif key in self._pending_gets:
+                self.forward_get(ctx, key)
+
+        if timer.startswith('flushPut:'):
+            key = timer[len('flushPut:'):]
+            if key in self._pending_puts:
+                self.flush_put(ctx, key)
+
         if timer == 'PUT_RESP':
             new_msg = Message('PUT_RESP')
             ctx.send_local(new_msg)
@@ -298,6 +826,8 @@ class Node(Process):
             new_msg = Message('DELETE_RESP')
             ctx.send_local(new_msg)
 
+        self.update_epoch()
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -305,12 +835,16 @@ def main():
                         help='node name (should be unique)', default='1')
     parser.add_argument('-l', dest='addr', metavar='host:port', 
                         help='listen on specified address', default='127.0.0.1:9701')
+    parser.add_argument('-m', dest='memory_budget', metavar='bytes', type=int,
+                        help='memory budget for values, cold values are spilled to disk', default=None)
+    parser.add_argument('-s', dest='spill_path', metavar='path',
+                        help='file for spilled values', default=None)
     parser.add_argument('-d', dest='log_level', action='store_const', const=logging.DEBUG,
                         help='print debugging info', default=logging.WARNING)
     args = parser.parse_args()
     logging.basicConfig(format="%(asctime)s - %(message)s", level=args.log_level)
 
-    node = Node(args.name)
+    node = Node(args.name, args.memory_budget, args.spill_path)
     Runtime(node, args.addr).start()
 
 
@@ -4,9 +4,11 @@ import argparse
 import logging
 import os
 import random
+import shutil
 import string
 import subprocess
 import sys
+import tempfile
 import time
 import threading
 import unittest
@@ -19,10 +21,11 @@ from dslib.test_server import TestMode, TestServer
 TEST_SERVER_ADDR = '127.0.0.1:9746'
 
 
-def run_node(impl_dir, name, addr, ts_addr, debug):
+def run_node(impl_dir, name, addr, ts_addr, debug, extra_args=()):
     env = os.environ.copy()
     env['TEST_SERVER'] = ts_addr
     cmd = ['python3', os.path.join(impl_dir, 'node.py'), '-n', name, '-l', addr]
+    cmd.extend(extra_args)
     if debug:
         cmd.append('-d')
         out = None
@@ -34,6 +37,7 @@ def run_node(impl_dir, name, addr, ts_addr, debug):
 
 
 class BaseTestCase(unittest.TestCase):
+    memory_budget = None              # если задан, node'ы запускаются с -m и своим файлом значений
 
     def __init__(self, impl_dir, node_count, debug=False):
         super(BaseTestCase, self).__init__()
@@ -46,6 +50,7 @@ class BaseTestCase(unittest.TestCase):
         super(BaseTestCase, self).setUp()
         sys.stderr.write("\n\n" + self.__class__.__name__ + " " + "-" * 60 + "\n\n")
 
+        self.spill_dir = tempfile.mkdtemp(prefix='kv-spill-') if self.memory_budget is not None else None
         self.ts = TestServer(TEST_SERVER_ADDR)
         self.ts.start()
         self.nodes = []
@@ -54,9 +59,14 @@ class BaseTestCase(unittest.TestCase):
             name = 'node%02d' % (i+1)
             addr = '127.0.0.1:97%02d' % (i+1)
             self.nodes.append(name)
-            proc = run_node(self.impl_dir, name, addr, TEST_SERVER_ADDR, self.debug)
+            proc = run_node(self.impl_dir, name, addr, TEST_SERVER_ADDR, self.debug, self.node_args(name))
             self.node_processes.append(proc)
 
+    def node_args(self, name):
+        if self.memory_budget is None:
+            return ()
+        return ['-m', str(self.memory_budget), '-s', os.path.join(self.spill_dir, name + '.log')]
+
     def tearDown(self):
         for i in range(len(self.node_processes)):
             self.node_processes[i].terminate()
@@ -66,6 +76,8 @@ class BaseTestCase(unittest.TestCase):
                 self.node_processes[i].kill()
             except OSError:
                 pass
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
 
     def init_cluster(self, group=None):
         if group is None:
@@ -252,6 +264,88 @@ class DeleteTestCase(BaseTestCase):
         self.check_distribution()
 
 
+class TtlTestCase(BaseTestCase):
+    """Записи, сохранённые с TTL, возвращаются до истечения срока и пропадают после него
+    (включая записи, которые успели переехать на другой узел при LEAVE), записи без TTL остаются."""
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(self.node_count, 5), "Startup timeout")
+
+        self.keys_count = 20
+        self.init_cluster()
+
+        ttl_keys = self.keys[:self.keys_count // 2]
+        for k in ttl_keys:
+            node = random.choice(self.nodes)
+            self.ts.send_local_message(node, Message('PUT', f"{k}={self.values[k]};1"))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "PUT response is not received")
+            self.assertEqual(msg.type, 'PUT_RESP')
+
+        for k in ttl_keys:
+            node = random.choice(self.nodes)
+            self.ts.send_local_message(node, Message('GET', k))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "GET response is not received")
+            self.assertEqual(msg.type, 'GET_RESP')
+            self.assertEqual(msg.body, self.values[k])
+
+        leave_node = random.choice(self.nodes)
+        self.ts.send_local_message(leave_node, Message('LEAVE'))
+        self.nodes.remove(leave_node)
+
+        start = time.time()
+        while time.time() - start < 2:
+            self.ts.steps(10, 0.1)
+
+        for k in self.keys:
+            node = random.choice(self.nodes)
+            self.ts.send_local_message(node, Message('GET', k))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "GET response is not received")
+            self.assertEqual(msg.type, 'GET_RESP')
+            self.assertEqual(msg.body, '' if k in ttl_keys else self.values[k])
+
+        self.keys = self.keys[self.keys_count // 2:]
+        self.step_until_stabilized()
+        self.check_distribution()
+
+
+class ZeroTtlTestCase(BaseTestCase):
+    """PUT с TTL 0 удаляет запись одинаково, пришёл ли он сразу владельцу или через другую node'у."""
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(self.node_count, 5), "Startup timeout")
+
+        self.keys_count = 10
+        self.init_cluster()
+
+        zero_keys = self.keys[:4]
+        for i, k in enumerate(zero_keys):
+            self.ts.send_local_message(self.nodes[0], Message('LOOKUP', k))
+            msg = self.ts.step_until_local_message(self.nodes[0], 1)
+            self.assertIsNotNone(msg, "LOOKUP response is not received")
+            self.assertEqual(msg.type, 'LOOKUP_RESP')
+            # половина ключей - через владельца, половина - через другую node'у
+            node = msg.body if i % 2 == 0 else random.choice([x for x in self.nodes if x != msg.body])
+            self.ts.send_local_message(node, Message('PUT', f"{k}={self.values[k]};0"))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "PUT response is not received")
+            self.assertEqual(msg.type, 'PUT_RESP')
+
+        for k in self.keys:
+            node = random.choice(self.nodes)
+            self.ts.send_local_message(node, Message('GET', k))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "GET response is not received")
+            self.assertEqual(msg.type, 'GET_RESP')
+            self.assertEqual(msg.body, '' if k in zero_keys else self.values[k])
+
+        self.keys = self.keys[len(zero_keys):]
+        self.step_until_stabilized()
+        self.check_distribution()
+
+
 class LeaveTestCase(BaseTestCase):
 
     def runTest(self):
@@ -275,6 +369,180 @@ class LeaveTestCase(BaseTestCase):
         self.check_distribution()
 
 
+class SpillLeaveTestCase(LeaveTestCase):
+    """Уход node'ы с маленьким бюджетом памяти: большая часть значений читается из файла перед передачей."""
+    memory_budget = 64
+
+
+class SpillCompactTestCase(BaseTestCase):
+    """Значения перезаписываются, пока файл значений не вырастет больше COMPACT_MIN_BYTES;
+    после сжатия файл становится меньше, а все значения читаются правильно."""
+    memory_budget = 64
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(self.node_count, 5), "Startup timeout")
+        node = self.nodes[0]
+        self.ts.send_local_message(node, Message('JOIN', self.ts.get_process_addr(node)))
+        self.keys = ['key%02d' % i for i in range(32)]
+        self.step_until_stabilized(expect_keys=0)
+
+        # три раунда по 32 значения по 16 КБ: файл ~1.5 МБ, из них ~1 МБ - перезаписанные значения
+        for _ in range(3):
+            self.values = {key: random.choice(string.ascii_lowercase) * (16 << 10) for key in self.keys}
+            for key in self.keys:
+                self.ts.send_local_message(node, Message('PUT', f"{key}={self.values[key]}"))
+                msg = self.ts.step_until_local_message(node, 1)
+                self.assertIsNotNone(msg, "PUT response is not received")
+                self.assertEqual(msg.type, 'PUT_RESP')
+        spill_path = os.path.join(self.spill_dir, node + '.log')
+        self.assertGreaterEqual(os.path.getsize(spill_path), 1 << 20)
+
+        # сжатие проверяется по таймеру раз в COMPACT_PERIOD секунд
+        start = time.time()
+        while time.time() - start < 12:
+            self.ts.steps(10, 0.1)
+        self.assertLess(os.path.getsize(spill_path), 1 << 20, "Value log is not compacted")
+
+        for key in self.keys:
+            self.ts.send_local_message(node, Message('GET', key))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "GET response is not received")
+            self.assertEqual(msg.type, 'GET_RESP')
+            self.assertEqual(msg.body, self.values[key])
+
+
+class CoalesceTestCase(BaseTestCase):
+    """Одинаковые GET'ы к чужому ключу, пришедшие подряд, получают ответ владельца; из пачки PUT'ов к чужому ключу
+    сохраняется последнее значение, и GET до отправки владельцу тоже видит его."""
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(self.node_count, 5), "Startup timeout")
+
+        self.keys_count = 10
+        self.init_cluster()
+
+        for k in self.keys:
+            self.ts.send_local_message(self.nodes[0], Message('LOOKUP', k))
+            msg = self.ts.step_until_local_message(self.nodes[0], 1)
+            self.assertIsNotNone(msg, "LOOKUP response is not received")
+            self.assertEqual(msg.type, 'LOOKUP_RESP')
+            node = random.choice([x for x in self.nodes if x != msg.body])
+
+            for _ in range(3):
+                self.ts.send_local_message(node, Message('GET', k))
+            for _ in range(3):
+                msg = self.ts.step_until_local_message(node, 2)
+                self.assertIsNotNone(msg, "GET response is not received")
+                self.assertEqual(msg.type, 'GET_RESP')
+                self.assertEqual(msg.body, self.values[k])
+
+            values = [''.join(random.choices(string.ascii_lowercase, k=8)) for _ in range(3)]
+            for value in values:
+                self.ts.send_local_message(node, Message('PUT', f"{k}={value}"))
+            self.ts.send_local_message(node, Message('GET', k))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "GET response is not received")
+            self.assertEqual(msg.type, 'GET_RESP')
+            self.assertEqual(msg.body, values[-1])
+            # ответы на PUT'ы пачки - сколько бы их ни было
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "PUT response is not received")
+            while msg is not None:
+                self.assertEqual(msg.type, 'PUT_RESP')
+                msg = self.ts.step_until_local_message(node, 0.5)
+            self.values[k] = values[-1]
+
+        for k in self.keys:
+            node = random.choice(self.nodes)
+            self.ts.send_local_message(node, Message('GET', k))
+            msg = self.ts.step_until_local_message(node, 1)
+            self.assertIsNotNone(msg, "GET response is not received")
+            self.assertEqual(msg.type, 'GET_RESP')
+            self.assertEqual(msg.body, self.values[k])
+
+        self.check_distribution()
+
+
+class RedirectTestCase(BaseTestCase):
+    """GET'ы к ключам уходящей node'ы отправляются сразу вместе с LEAVE: пока node'ы ещё не знают об уходе,
+    запросы приходят к ушедшей node'е, и она через REDIRECT отправляет их к новым владельцам."""
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(self.node_count, 5), "Startup timeout")
+
+        self.keys_count = 100
+        self.init_cluster()
+
+        leave_node = random.choice(self.nodes)
+        self.ts.send_local_message(leave_node, Message('DUMP_KEYS'))
+        msg = self.ts.step_until_local_message(leave_node, 1)
+        self.assertIsNotNone(msg, "DUMP_KEYS response is not received")
+        self.assertEqual(msg.type, 'DUMP_KEYS_RESP')
+        leave_keys = list(msg.body)
+        self.assertTrue(len(leave_keys) > 0, "Node stores no records, bad distribution")
+
+        self.ts.send_local_message(leave_node, Message('LEAVE'))
+        self.nodes.remove(leave_node)
+        for node in self.nodes:
+            for k in leave_keys:
+                self.ts.send_local_message(node, Message('GET', k))
+
+        # ответы на пересланные GET'ы приходят не по порядку - сравниваем наборы значений
+        expected = sorted(self.values[k] for k in leave_keys)
+        for node in self.nodes:
+            values = []
+            for _ in leave_keys:
+                msg = self.ts.step_until_local_message(node, 5)
+                self.assertIsNotNone(msg, "GET response is not received")
+                self.assertEqual(msg.type, 'GET_RESP')
+                values.append(msg.body)
+            self.assertEqual(sorted(values), expected)
+
+        self.step_until_stabilized()
+        self.check_distribution()
+
+
+class LoadBalanceTestCase(BaseTestCase):
+    """Node'а, которая обслуживает намного больше запросов, чем остальные, уменьшает свой вес и отдаёт часть
+    ключей; все записи при этом остаются доступными."""
+
+    def runTest(self):
+        self.assertTrue(self.ts.wait_processes(self.node_count, 5), "Startup timeout")
+
+        self.keys_count = 90
+        self.init_cluster()
+
+        hot_node = random.choice(self.nodes)
+        self.ts.send_local_message(hot_node, Message('DUMP_KEYS'))
+        msg = self.ts.step_until_local_message(hot_node, 1)
+        self.assertIsNotNone(msg, "DUMP_KEYS response is not received")
+        self.assertEqual(msg.type, 'DUMP_KEYS_RESP')
+        hot_keys = list(msg.body)
+        self.assertTrue(len(hot_keys) > 0, "Node stores no records, bad distribution")
+
+        # четыре периода LOAD_PERIOD: вес меняется не больше чем на 10% за период
+        start = time.time()
+        while time.time() - start < 21:
+            batch = random.choices(hot_keys, k=100)
+            for k in batch:
+                self.ts.send_local_message(hot_node, Message('GET', k))
+            values = []
+            for _ in batch:
+                msg = self.ts.step_until_local_message(hot_node, 5)
+                self.assertIsNotNone(msg, "GET response is not received")
+                self.assertEqual(msg.type, 'GET_RESP')
+                values.append(msg.body)
+            self.assertEqual(sorted(values), sorted(self.values[k] for k in batch))
+
+        self.step_until_stabilized()
+        self.ts.send_local_message(hot_node, Message('COUNT_RECORDS'))
+        msg = self.ts.step_until_local_message(hot_node, 1)
+        self.assertIsNotNone(msg, "COUNT_RECORDS is not responced")
+        self.assertEqual(msg.type, 'COUNT_RECORDS_RESP')
+        self.assertLess(int(msg.body), len(hot_keys), "Loaded node did not give away keys")
+        self.check_distribution()
+
+
 class SwingTestCase(BaseTestCase):
 
     def runTest(self):
@@ -415,8 +683,22 @@ def main():
             args.impl_dir, 5, debug=args.debug),
         DeleteTestCase(
             args.impl_dir, 5, debug=args.debug),
+        TtlTestCase(
+            args.impl_dir, 5, debug=args.debug),
+        ZeroTtlTestCase(
+            args.impl_dir, 5, debug=args.debug),
         LeaveTestCase(
             args.impl_dir, 5, debug=args.debug),
+        SpillLeaveTestCase(
+            args.impl_dir, 5, debug=args.debug),
+        SpillCompactTestCase(
+            args.impl_dir, 1, debug=args.debug),
+        CoalesceTestCase(
+            args.impl_dir, 5, debug=args.debug),
+        RedirectTestCase(
+            args.impl_dir, 5, debug=args.debug),
+        LoadBalanceTestCase(
+            args.impl_dir, 3, debug=args.debug),
         SwingTestCase(
             args.impl_dir, 10, debug=args.debug),
         CrashTestCase(